@@ -0,0 +1,365 @@
+"""Офлайн-бенчмарк обработчиков бота.
+
+Строит синтетические деревья файлов и вызывает обработчики (ls, search, view, download, cp, rm)
+через поддельные Update/Message/Bot, которые только запоминают ответы. Сеть и токен не нужны.
+
+Использование:
+    python bench.py [--scale=1] [--iterations=5] [--only=ls_wide,search_name]
+                    [--save=baseline.json] [--compare=baseline.json] [--threshold=0.2]
+"""
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import asyncio
+import argparse
+import tempfile
+import platform
+import statistics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+WORK_DIR = tempfile.mkdtemp(prefix="fm-bench-")
+
+# Конфигурация бота до импорта main: всё пишется во временную папку
+os.environ.update({
+    "TOKEN": "bench",
+    "AUTHORIZED_USER_ID": "1",
+    "LOG_FILE": os.path.join(WORK_DIR, "actions.log"),
+    "SETTINGS_DB_FILE": os.path.join(WORK_DIR, "settings.json"),
+    "STATE_DB_FILE": os.path.join(WORK_DIR, "state.sqlite3"),
+    "AUDIT_DB_FILE": "",
+    "INDEX_DB_FILE": os.path.join(WORK_DIR, "file_index.db"),
+})
+
+import main  # noqa: E402
+
+# Отчёт JSON выводится в stdout, поэтому журнал действий туда не дублируется
+main.action_log.echo = False
+
+USER_ID = 1
+
+# Подмена Telegram: сообщения и документы только подсчитываются
+
+class FakeBot:
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return self.recorder.message(text)
+
+    async def send_document(self, chat_id, document=None, filename=None, **kwargs):
+        return self.recorder.document(document)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.recorder.edit(text)
+        return True
+
+class FakeMessage:
+    next_id = 1
+
+    def __init__(self, recorder, text=""):
+        self.recorder = recorder
+        self.text = text
+        self.chat_id = USER_ID
+        self.message_id = FakeMessage.next_id
+        FakeMessage.next_id += 1
+
+    async def reply_text(self, text, **kwargs):
+        return self.recorder.message(text)
+
+    async def reply_document(self, document=None, filename=None, **kwargs):
+        return self.recorder.document(document)
+
+    async def edit_text(self, text, **kwargs):
+        self.recorder.edit(text)
+        return self
+
+class Recorder:
+    def __init__(self):
+        self.messages = 0
+        self.documents = 0
+        self.edits = 0
+        self.bytes = 0
+
+    def message(self, text):
+        self.messages += 1
+        self.bytes += len(text.encode("utf-8"))
+        return FakeMessage(self, text)
+
+    def document(self, document):
+        self.documents += 1
+        if isinstance(document, (bytes, bytearray)):
+            self.bytes += len(document)
+        elif hasattr(document, "read"):
+            self.bytes += len(document.read())
+        return FakeMessage(self)
+
+    def edit(self, text):
+        self.edits += 1
+        self.bytes += len(text.encode("utf-8"))
+
+def make_update(recorder, args):
+    update = types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=USER_ID),
+        effective_chat=types.SimpleNamespace(id=USER_ID),
+        message=FakeMessage(recorder, " ".join(args)),
+        callback_query=None,
+    )
+    update.effective_message = update.message
+    context = types.SimpleNamespace(args=list(args), bot=FakeBot(recorder))
+    return update, context
+
+# Синтетические деревья
+
+def write_file(path, size, fill=b"x"):
+    with open(path, "wb") as f:
+        block = (fill * 1024)[:1024 * 1024] if size > 1024 else fill * size
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+def build_wide(root, scale):
+    os.makedirs(root)
+    for i in range(int(20000 * scale)):
+        write_file(os.path.join(root, f"file_{i:06d}.txt"), 16)
+    for i in range(int(200 * scale)):
+        os.mkdir(os.path.join(root, f"dir_{i:04d}"))
+
+def build_long(root, scale):
+    # Имена по 150 символов: страница /ls упирается в лимит длины сообщения раньше, чем в page_size
+    os.makedirs(root)
+    for i in range(max(120, int(2000 * scale))):
+        write_file(os.path.join(root, f"{i:06d}_" + "n" * 143), 16)
+
+def build_deep(root, scale):
+    path = root
+    for level in range(int(150 * scale)):
+        path = os.path.join(path, f"level_{level:03d}")
+        os.makedirs(path)
+        write_file(os.path.join(path, f"note_{level}.md"), 64)
+
+def build_small(root, scale):
+    # Не меньше трёх групп: сценарии download и cp берут group_001 и group_002
+    for d in range(max(3, int(100 * scale))):
+        folder = os.path.join(root, f"group_{d:03d}", "sub")
+        os.makedirs(folder)
+        for i in range(50):
+            name = f"item_{i:02d}.txt" if i % 5 else f"item_{i:02d}.log"
+            content = b"needle\n" if i == 7 else b"hay\n"
+            write_file(os.path.join(folder, name), 512, content)
+
+def build_huge(root, scale):
+    os.makedirs(root)
+    line = b"2024-01-01 12:00:00 INFO request handled in 12ms\n"
+    for i in range(3):
+        write_file(os.path.join(root, f"big_{i}.log"), int(64 * 1024 * 1024 * scale), line)
+
+TREES = {"wide": build_wide, "long": build_long, "deep": build_deep, "small": build_small, "huge": build_huge}
+
+# Сценарии: дерево, обработчик, аргументы, подготовка и уборка (вне замера)
+
+def copy_for_rm(tree_root, iteration):
+    shutil.copytree(os.path.join(tree_root, "group_000"), os.path.join(tree_root, f"rm_{iteration}"))
+
+def remove_cp_result(tree_root, iteration):
+    shutil.rmtree(os.path.join(tree_root, f"cp_{iteration}"), ignore_errors=True)
+
+SCENARIOS = [
+    {"name": "ls_wide", "tree": "wide", "handler": "ls", "args": lambda i: []},
+    {"name": "ls_wide_cold", "tree": "wide", "handler": "ls", "args": lambda i: [],
+     "setup": lambda root, i: main.invalidate_index()},
+    {"name": "ls_wide_page", "tree": "wide", "handler": "ls", "args": lambda i: ["--page=50"]},
+    {"name": "ls_long_names", "tree": "long", "handler": "ls", "args": lambda i: ["--page=2"]},
+    {"name": "search_name", "tree": "small", "handler": "search", "args": lambda i: ["*.log"]},
+    {"name": "search_deep", "tree": "deep", "handler": "search", "args": lambda i: ["note_1*"]},
+    {"name": "search_content", "tree": "small", "handler": "search", "args": lambda i: ["content:needle"]},
+    {"name": "view_huge_head", "tree": "huge", "handler": "view_file", "args": lambda i: ["big_0.log"]},
+    {"name": "view_huge_page", "tree": "huge", "handler": "view_file", "args": lambda i: ["big_0.log", "--page=500"]},
+    {"name": "view_huge_tail", "tree": "huge", "handler": "view_file", "args": lambda i: ["big_1.log", "--tail=40"]},
+    {"name": "download_small", "tree": "small", "handler": "download_file", "args": lambda i: ["group_001"]},
+    {"name": "download_huge", "tree": "huge", "handler": "download_file", "args": lambda i: ["big_2.log"]},
+    {"name": "cp_small", "tree": "small", "handler": "cp", "args": lambda i: ["group_002", f"cp_{i}"],
+     "teardown": remove_cp_result},
+    {"name": "rm_small", "tree": "small", "handler": "rm", "args": lambda i: [f"rm_{i}"], "setup": copy_for_rm},
+]
+
+# Счётчики процесса
+
+def read_proc_io():
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key.strip()] = int(value)
+    except OSError:
+        pass
+    return counters
+
+def reset_peak_rss():
+    # Linux 4.0+: запись 5 в clear_refs сбрасывает пиковый RSS (VmHWM)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+    return None
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# Прогон
+
+async def run_scenario(scenario, tree_root, iterations, warmup):
+    handler = getattr(main, scenario["handler"])
+    main.set_current_dir(USER_ID, tree_root)
+    latencies = []
+    recorder = Recorder()
+    io_totals = {}
+    for i in range(warmup + iterations):
+        if scenario.get("setup"):
+            scenario["setup"](tree_root, i)
+        measured = i >= warmup
+        if measured and i == warmup:
+            reset_peak_rss()
+            recorder = Recorder()
+        update, context = make_update(recorder, scenario["args"](i))
+        io_before = read_proc_io()
+        started = time.perf_counter()
+        await handler(update, context)
+        elapsed = time.perf_counter() - started
+        io_after = read_proc_io()
+        if measured:
+            latencies.append(elapsed * 1000)
+            for key, value in io_after.items():
+                io_totals[key] = io_totals.get(key, 0) + value - io_before.get(key, 0)
+        if scenario.get("teardown"):
+            scenario["teardown"](tree_root, i)
+    result = {
+        "iterations": iterations,
+        "latency_ms": {
+            "min": min(latencies),
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies),
+            "mean": statistics.fmean(latencies),
+        },
+        "peak_rss_kb": peak_rss_kb(),
+        "replies": {
+            "messages": recorder.messages / iterations,
+            "documents": recorder.documents / iterations,
+            "edits": recorder.edits / iterations,
+            "bytes": recorder.bytes / iterations,
+        },
+    }
+    if io_totals:
+        # Средние на одну итерацию; процессы пула (поиск по содержимому) сюда не входят
+        result["io"] = {
+            "read_syscalls": io_totals.get("syscr", 0) / iterations,
+            "write_syscalls": io_totals.get("syscw", 0) / iterations,
+            "bytes_read": io_totals.get("rchar", 0) / iterations,
+            "bytes_written": io_totals.get("wchar", 0) / iterations,
+            "disk_read_bytes": io_totals.get("read_bytes", 0) / iterations,
+        }
+    return result
+
+async def run_all(scenarios, scale, iterations, warmup):
+    # Задачи выполняются inline, прогресс копирования не рисуется
+    main.JOB_INLINE_WAIT = 3600
+    main.COPY_PROGRESS_INTERVAL = 3600
+    trees_root = os.path.join(WORK_DIR, "trees")
+    built = {}
+    results = {}
+    for scenario in scenarios:
+        tree = scenario["tree"]
+        if tree not in built:
+            started = time.perf_counter()
+            built[tree] = os.path.join(trees_root, tree)
+            TREES[tree](built[tree], scale)
+            print(f"дерево {tree}: {time.perf_counter() - started:.1f} с", file=sys.stderr)
+        results[scenario["name"]] = await run_scenario(scenario, built[tree], iterations, warmup)
+        latency = results[scenario["name"]]["latency_ms"]
+        print(f"{scenario['name']:<18} p50 {latency['p50']:9.1f} мс  p99 {latency['p99']:9.1f} мс", file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        before = old["latency_ms"]["p50"]
+        after = result["latency_ms"]["p50"]
+        change = (after - before) / before if before else 0.0
+        mark = "РЕГРЕССИЯ" if change > threshold else ""
+        print(f"{name:<18} p50 {before:9.1f} -> {after:9.1f} мс ({change:+.0%}) {mark}", file=sys.stderr)
+        if mark:
+            regressions.append(name)
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    parser.add_argument("--scale", type=float, default=1.0, help="Множитель размера деревьев")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--only", help="Сценарии через запятую")
+    parser.add_argument("--save", help="Сохранить результаты в JSON")
+    parser.add_argument("--compare", help="Сравнить с сохранённым JSON")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Допустимое замедление p50 (0.2 = 20%%)")
+    parser.add_argument("--keep", action="store_true", help="Не удалять временную папку")
+    options = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if options.only:
+        names = set(options.only.split(","))
+        scenarios = [s for s in SCENARIOS if s["name"] in names]
+    try:
+        results = asyncio.run(run_all(scenarios, options.scale, options.iterations, options.warmup))
+    finally:
+        main.flush_state_db()
+        main.shutdown_executors()
+        main.action_log.close()
+        if not options.keep:
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": options.scale,
+        "scenarios": results,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if options.save:
+        with open(options.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,28 +1,63 @@
 import os
+import sys
 import logging
 import json
 import zipfile
 import fnmatch
 import re
+import shlex
+import sqlite3
+import threading
+import time
+import queue
+import gzip
+import glob
+import atexit
+import errno
+import stat
 from datetime import datetime, timedelta
-from telegram import Update, BotCommand
+from telegram import Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackContext,
+    CallbackQueryHandler,
     MessageHandler,
     filters,
 )
 import shutil
+import tempfile
 import asyncio
+import functools
+import multiprocessing
+import contextvars
+import hashlib
+import mmap
+import bisect
+import tarfile
+import httpx
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 # Загрузка переменных окружения
 load_dotenv()
 
 # Токен вашего бота
 TOKEN = os.getenv("TOKEN")
 
+# Свой сервер Bot API (telegram-bot-api), например http://localhost:8081. Публичный сервер
+# отдаёт боту файлы не больше 20 МБ; с TELEGRAM_LOCAL_MODE=1 файлы читаются прямо с диска сервера
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+TELEGRAM_LOCAL_MODE = os.getenv("TELEGRAM_LOCAL_MODE", "off").lower() in ("on", "1", "true", "yes")
+
 # Ваш айди в телеграме
 AUTHORIZED_USER_ID = int(os.getenv("AUTHORIZED_USER_ID"))
 
@@ -39,12 +74,136 @@ logger = logging.getLogger(__name__)
 # Файл для логирования действий
 LOG_FILE = os.getenv("LOG_FILE")
 
+# Политика fsync журнала действий: never, batch (после каждой пачки записей) или always (после каждой записи)
+LOG_FSYNC = os.getenv("LOG_FSYNC", "never")
+
+# Ротация журнала действий: по размеру (байты) и/или по времени (секунды), 0 — выключено
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", "0"))
+LOG_ROTATE_INTERVAL = int(os.getenv("LOG_ROTATE_INTERVAL", "0"))
+
+# Сколько старых сегментов хранить и сжимать ли их gzip
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_COMPRESS = os.getenv("LOG_COMPRESS", "off").lower() in ("on", "1", "true", "yes")
+
+# База журнала действий для /audit (SQLite); пустая строка — не вести
+AUDIT_DB_FILE = os.getenv("AUDIT_DB_FILE", "audit.db")
+
+# Бюджеты размера записи журнала: сколько элементов списка и символов строки сохраняется
+LOG_MAX_ITEMS = int(os.getenv("LOG_MAX_ITEMS", "20"))
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000"))
+
+# Поля, вместо содержимого которых пишется хэш
+LOG_HASHED_FIELDS = {"content"}
+
+# Необязательный отладочный журнал с полными данными (без ограничений размера)
+DEBUG_LOG_FILE = os.getenv("DEBUG_LOG_FILE")
+
 # Файл для базы настроек
 SETTINGS_DB_FILE = os.getenv("SETTINGS_DB_FILE")
 
+# База состояния пользователей (SQLite). Старый JSON из SETTINGS_DB_FILE переносится в неё при первом запуске
+STATE_DB_FILE = os.getenv("STATE_DB_FILE") or (
+    os.path.splitext(SETTINGS_DB_FILE)[0] + ".sqlite3" if SETTINGS_DB_FILE else "state.sqlite3"
+)
+
+# Задержка (в секундах), с которой изменения настроек пачкой сбрасываются на диск
+STATE_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY", "2"))
+
 # Локальная база настроек
 user_settings = {}
 
+# Файл индекса имён файлов для /search
+INDEX_DB_FILE = os.getenv("INDEX_DB_FILE", "file_index.db")
+
+# Как часто (в секундах) индекс сверяется с диском по mtime директорий
+INDEX_RESCAN_INTERVAL = int(os.getenv("INDEX_RESCAN_INTERVAL", "60"))
+
+# Корни полнотекстового индекса для content: (через os.pathsep); пусто — индекс выключен
+CONTENT_INDEX_ROOTS = [
+    os.path.normpath(p) for p in os.getenv("CONTENT_INDEX_ROOTS", "").split(os.pathsep) if p.strip()
+]
+
+# Файлы больше этого размера (в байтах) в полнотекстовый индекс не попадают
+CONTENT_INDEX_MAX_FILE_SIZE = int(os.getenv("CONTENT_INDEX_MAX_FILE_SIZE", str(10 * 1024 * 1024)))
+
+# Сколько строк показывает одна страница /view
+VIEW_PAGE_LINES = int(os.getenv("VIEW_PAGE_LINES", "40"))
+
+# Шаг (в байтах) контрольных точек индекса строк для /view
+VIEW_INDEX_STEP = int(os.getenv("VIEW_INDEX_STEP", str(64 * 1024)))
+
+# Ограничения на отображение страницы: длина одной строки и всего текста страницы
+VIEW_MAX_LINE_LENGTH = 500
+VIEW_MAX_PAGE_CHARS = 3500
+
+# Сколько записей показывает одна страница /ls (можно изменить через /settings page_size)
+# и сколько секунд отсортированный список переиспользуется при листании
+LS_PAGE_SIZE = int(os.getenv("LS_PAGE_SIZE", "50"))
+LS_SESSION_TTL = float(os.getenv("LS_SESSION_TTL", "300"))
+
+# /cp: число параллельно копируемых файлов (0 — подобрать по типу диска: HDD — 1, SSD — 8),
+# размер блока копирования и как часто обновляется сообщение с прогрессом
+COPY_WORKERS = int(os.getenv("COPY_WORKERS", "0"))
+COPY_CHUNK_SIZE = int(os.getenv("COPY_CHUNK_SIZE", str(8 * 1024 * 1024)))
+COPY_PROGRESS_INTERVAL = float(os.getenv("COPY_PROGRESS_INTERVAL", "3"))
+
+# /dupes: размер блоков в начале и в конце файла для частичного хэша и сколько файлов
+# уходит в процесс пула за раз
+DUPES_PARTIAL_BLOCK = int(os.getenv("DUPES_PARTIAL_BLOCK", str(64 * 1024)))
+DUPES_HASH_BATCH_SIZE = int(os.getenv("DUPES_HASH_BATCH_SIZE", "64"))
+
+# Сколько папок держит кэш размеров /du
+DU_CACHE_SIZE = int(os.getenv("DU_CACHE_SIZE", "200000"))
+
+# Сколько директорий держит кэш содержимого для /ls
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", "64"))
+
+# /tail -f: как часто проверяется файл, как часто обновляется сообщение и сколько строк в нём
+TAIL_POLL_INTERVAL = float(os.getenv("TAIL_POLL_INTERVAL", "1"))
+TAIL_EDIT_INTERVAL = float(os.getenv("TAIL_EDIT_INTERVAL", "3"))
+TAIL_LINES = int(os.getenv("TAIL_LINES", "30"))
+
+# Сколько байт архива /download держится в памяти, прежде чем буфер уйдёт во временный файл
+DOWNLOAD_SPOOL_SIZE = int(os.getenv("DOWNLOAD_SPOOL_SIZE", str(16 * 1024 * 1024)))
+
+# Максимальный размер одной части /download (лимит Telegram для ботов — 50 МБ)
+DOWNLOAD_PART_SIZE = int(os.getenv("DOWNLOAD_PART_SIZE", str(49 * 1024 * 1024)))
+
+# Сколько частей отправляется одновременно и сколько попыток даётся каждой
+DOWNLOAD_UPLOAD_PARALLELISM = int(os.getenv("DOWNLOAD_UPLOAD_PARALLELISM", "3"))
+DOWNLOAD_UPLOAD_RETRIES = int(os.getenv("DOWNLOAD_UPLOAD_RETRIES", "3"))
+
+# Загрузка файлов в бота: размер блока записи и распаковывать ли архивы без подписи --extract
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+UPLOAD_EXTRACT = os.getenv("UPLOAD_EXTRACT", "off").lower() in ("on", "1", "true", "yes")
+
+# Расширения уже сжатых файлов: в архив они кладутся без повторного сжатия
+COMPRESSED_EXTENSIONS = {
+    ".zip", ".rar", ".gz", ".7z", ".bz2", ".xz", ".zst", ".jar", ".apk",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".avi",
+    ".mov", ".ogg", ".flac", ".pdf", ".docx", ".xlsx", ".pptx", ".luac",
+}
+
+# Методы сжатия для /download --compress=
+ZIP_COMPRESSION = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+if hasattr(zipfile, "ZIP_ZSTANDARD"):  # Python 3.14+
+    ZIP_COMPRESSION["zstd"] = zipfile.ZIP_ZSTANDARD
+
+# Размер блока чтения и число файлов в одной задаче пула процессов при поиске по содержимому
+CONTENT_SCAN_CHUNK_SIZE = int(os.getenv("CONTENT_SCAN_CHUNK_SIZE", str(1024 * 1024)))
+CONTENT_SCAN_BATCH_SIZE = int(os.getenv("CONTENT_SCAN_BATCH_SIZE", "64"))
+
+# Максимум результатов /search по умолчанию (переопределяется через --limit=N)
+SEARCH_RESULT_LIMIT = int(os.getenv("SEARCH_RESULT_LIMIT", "500"))
+
+# Как часто (в секундах) найденные по содержимому файлы отправляются в чат
+SEARCH_FLUSH_INTERVAL = float(os.getenv("SEARCH_FLUSH_INTERVAL", "2"))
+
 # Словарь эмодзи для расширений
 EMOJI_MAP = {
     ".appinstaller": "📥",
@@ -74,30 +233,416 @@ EMOJI_MAP = {
     ".csv": "📊",
 }
 
-# Хранение текущей директории для каждого пользователя
-current_dirs = {}
+# Сессии пользователей (текущая директория, история переходов, недавние папки);
+# загружаются из базы состояния при старте
+user_sessions = {}
+
+# Сколько переходов хранится в истории для `cd -` и `/history`
+SESSION_HISTORY_SIZE = int(os.getenv("SESSION_HISTORY_SIZE", "20"))
+
+# Размеры пулов для блокирующих операций с файловой системой
+IO_THREADS = int(os.getenv("IO_THREADS", "8"))
+CPU_PROCESSES = int(os.getenv("CPU_PROCESSES", "0")) or (os.cpu_count() or 2)
+
+# Сколько обновлений Telegram обрабатывается одновременно: пока команда одного чата ждёт
+# диск, команды других чатов не стоят в очереди за ней
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Лимит одновременных операций для команд, не указанных в COMMAND_LIMITS
+DEFAULT_COMMAND_LIMIT = int(os.getenv("DEFAULT_COMMAND_LIMIT", "4"))
+
+# Лимиты одновременных операций по командам, формат: "cp=2,rm=2,search=2"
+def parse_command_limits(value):
+    limits = {"cp": 4, "mv": 2, "rm": 2, "search": 2, "download": 2}
+    for part in filter(None, (p.strip() for p in (value or "").split(","))):
+        name, _, limit = part.partition("=")
+        try:
+            limits[name.strip()] = max(1, int(limit))
+        except ValueError:
+            logger.error("Неверный лимит команды: %s", part)
+    return limits
 
-# Загрузка настроек из файла
+COMMAND_LIMITS = parse_command_limits(os.getenv("COMMAND_LIMITS"))
+
+# Общий пул потоков для работы с диском и ленивый пул процессов для CPU-задач
+io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="fs-worker")
+process_executor = None
+command_semaphores = {}
+
+# Процессы запускаются через forkserver (или spawn), а не fork: к этому моменту в боте уже
+# работают потоки пула, журнала и профилировщика, и форк мог бы унаследовать занятые ими
+# блокировки (logging, sqlite). Функции для пула — на уровне модуля и сериализуются.
+def get_process_executor():
+    global process_executor
+    if process_executor is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        process_executor = ProcessPoolExecutor(max_workers=CPU_PROCESSES, mp_context=multiprocessing.get_context(method))
+    return process_executor
+
+def get_command_semaphore(command):
+    if command not in command_semaphores:
+        command_semaphores[command] = asyncio.Semaphore(COMMAND_LIMITS.get(command, DEFAULT_COMMAND_LIMIT))
+    return command_semaphores[command]
+
+# Метрики команд: полное время, ожидание пулов (время, заблокированное на I/O), байты
+# чтения/записи и число запросов к Telegram. Хранятся в памяти для /stats, по желанию
+# экспортируются в формате Prometheus в файл и/или на локальный порт.
+STATS_WINDOW = int(os.getenv("STATS_WINDOW", "1000"))
+STATS_PROMETHEUS_FILE = os.getenv("STATS_PROMETHEUS_FILE")
+STATS_PROMETHEUS_PORT = int(os.getenv("STATS_PROMETHEUS_PORT", "0"))
+STATS_EXPORT_INTERVAL = float(os.getenv("STATS_EXPORT_INTERVAL", "15"))
+STATS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Профилировщик медленных команд: пока команда выполняется, раз в PROFILE_INTERVAL
+# снимаются стеки всех потоков; если команда заняла больше PROFILE_SLOW_MS (0 — выключено),
+# самые частые стеки сохраняются в PROFILE_DIR
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Счётчики ввода-вывода потока (только Linux)
+THREAD_IO_FILE = "/proc/thread-self/io"
+THREAD_IO_AVAILABLE = os.path.exists(THREAD_IO_FILE)
+
+current_stats = contextvars.ContextVar("current_stats", default=None)
+command_stats = {}
+stats_lock = threading.Lock()
+
+def add_stats(**values):
+    stats = current_stats.get()
+    if stats is not None:
+        with stats_lock:
+            for key, value in values.items():
+                stats[key] += value
+
+def read_thread_io():
+    counters = {}
+    with open(THREAD_IO_FILE) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            counters[key] = int(value)
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+# Выполняется в потоке пула: прочитанные и записанные байты берутся из счётчиков этого потока,
+# а сам поток на время работы попадает в профиль команды
+def run_measured(func, *args, **kwargs):
+    stats = current_stats.get()
+    if stats is None:
+        return func(*args, **kwargs)
+    ident = threading.get_ident()
+    if stats["profile"] is not None:
+        with stats_lock:
+            stats["threads"][ident] = stats["threads"].get(ident, 0) + 1
+    before = read_thread_io() if THREAD_IO_AVAILABLE else None
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if before is not None:
+            after = read_thread_io()
+            add_stats(read_bytes=after[0] - before[0], write_bytes=after[1] - before[1])
+        if stats["profile"] is not None:
+            with stats_lock:
+                stats["threads"][ident] -= 1
+                if not stats["threads"][ident]:
+                    del stats["threads"][ident]
+
+# Выполнение блокирующей функции в пуле потоков, не блокируя цикл событий бота
+async def run_blocking(command, func, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        async with get_command_semaphore(command):
+            loop = asyncio.get_running_loop()
+            # Контекст копируется, чтобы функция видела текущую фоновую задачу (check_cancelled)
+            # и метрики команды
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(io_executor, functools.partial(ctx.run, run_measured, func, *args, **kwargs))
+    finally:
+        add_stats(io_wait=time.perf_counter() - started)
+
+# То же самое, но в пуле процессов (функция и аргументы должны сериализоваться)
+async def run_in_process(command, func, *args):
+    started = time.perf_counter()
+    try:
+        async with get_command_semaphore(command):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_process_executor(), func, *args)
+    finally:
+        add_stats(io_wait=time.perf_counter() - started)
+
+def shutdown_executors():
+    io_executor.shutdown(wait=False, cancel_futures=True)
+    if process_executor is not None:
+        process_executor.shutdown(wait=False, cancel_futures=True)
+
+# Фоновые задачи (cp, mv, rm, search, download, dupes, upload). Задача, не уложившаяся в JOB_INLINE_WAIT
+# секунд, продолжается в фоне; её можно посмотреть в /jobs и отменить через /cancel.
+# Отмена кооперативная: блокирующий код периодически вызывает check_cancelled().
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "2"))
+JOB_MAX_GLOBAL = int(os.getenv("JOB_MAX_GLOBAL", "4"))
+JOB_INLINE_WAIT = float(os.getenv("JOB_INLINE_WAIT", "3"))
+JOB_HISTORY_SIZE = 20
+
+JOB_STATUS_NAMES = {
+    "queued": "в очереди",
+    "running": "выполняется",
+    "done": "завершена",
+    "failed": "ошибка",
+    "cancelled": "отменена",
+}
+
+class JobCancelled(Exception):
+    pass
+
+current_job = contextvars.ContextVar("current_job", default=None)
+jobs = OrderedDict()
+job_semaphores = {}
+next_job_id = 1
+
+def get_job_semaphore(key, limit):
+    if key not in job_semaphores:
+        job_semaphores[key] = asyncio.Semaphore(limit)
+    return job_semaphores[key]
+
+# Вызывается из блокирующего кода между шагами работы
+def check_cancelled():
+    job = current_job.get()
+    if job is not None and job["cancel"].is_set():
+        raise JobCancelled("Задача отменена")
+
+def report_job_progress(size=0, files=0):
+    job = current_job.get()
+    if job is not None:
+        with job["lock"]:
+            job["bytes"] += size
+            job["files"] += files
+
+async def run_job(job, coro):
+    current_job.set(job)
+    update = job["update"]
+    started = False
+    try:
+        async with get_job_semaphore("global", JOB_MAX_GLOBAL), get_job_semaphore(job["user_id"], JOB_MAX_PER_USER):
+            job["status"] = "running"
+            job["started"] = time.monotonic()
+            started = True
+            await coro
+        job["status"] = "done"
+    except (asyncio.CancelledError, JobCancelled):
+        job["status"] = "cancelled"
+        await update.message.reply_text(f"Задача #{job['id']} отменена: {job['title']}")
+    except Exception as e:
+        job["status"] = "failed"
+        logger.exception("Ошибка задачи #%s", job["id"])
+        await update.message.reply_text(f"Задача #{job['id']} завершилась с ошибкой: {e}")
+    finally:
+        if not started:
+            coro.close()
+        job["finished"] = time.monotonic()
+        stats = current_stats.get()
+        if stats is not None and stats["detached"]:
+            finish_command_stats(stats, job["status"] == "failed")
+        finished = [k for k, j in jobs.items() if j["status"] not in ("queued", "running")]
+        for key in finished[:-JOB_HISTORY_SIZE]:
+            jobs.pop(key, None)
+    if job["status"] == "done" and job["background"]:
+        elapsed = format_duration(job["finished"] - job["started"])
+        await update.message.reply_text(f"Задача #{job['id']} завершена за {elapsed}: {job['title']}")
+
+# Декоратор: команда выполняется как фоновая задача
+def background_job(command):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: CallbackContext):
+            global next_job_id
+            job = {
+                "id": next_job_id,
+                "user_id": update.effective_user.id,
+                "command": command,
+                "title": " ".join([command] + list(context.args or [])),
+                "update": update,
+                "status": "queued",
+                "created": time.monotonic(),
+                "started": None,
+                "finished": None,
+                "background": False,
+                "cancel": threading.Event(),
+                "lock": threading.Lock(),
+                "bytes": 0,
+                "files": 0,
+            }
+            next_job_id += 1
+            jobs[job["id"]] = job
+            job["task"] = asyncio.ensure_future(run_job(job, func(update, context)))
+            await asyncio.wait({job["task"]}, timeout=JOB_INLINE_WAIT)
+            if not job["task"].done():
+                job["background"] = True
+                # Метрики команды допишет сама задача, когда завершится
+                stats = current_stats.get()
+                if stats is not None:
+                    stats["detached"] = True
+                await update.message.reply_text(
+                    f"Задача #{job['id']} выполняется в фоне: {job['title']}\n"
+                    f"/jobs — список задач, /cancel {job['id']} — отменить"
+                )
+
+        return wrapper
+    return decorator
+
+def cancel_all_jobs():
+    for job in jobs.values():
+        job["cancel"].set()
+        if not job["task"].done():
+            job["task"].cancel()
+
+# Хранилище состояния: одна строка на пользователя, запись транзакцией SQLite (WAL),
+# поэтому сбой во время записи не портит настройки остальных пользователей
+dirty_state = set()  # пары (таблица, user_id)
+state_flush_handle = None
+state_db_lock = threading.Lock()
+
+def open_state_db():
+    conn = sqlite3.connect(STATE_DB_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS user_sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    return conn
+
+# Таблица состояния и словарь в памяти, который она отражает
+def state_store(table):
+    return user_settings if table == "user_settings" else user_sessions
+
+# Загрузка настроек из базы (или перенос из старого JSON-файла)
 def load_settings_db():
     global user_settings
-    if os.path.exists(SETTINGS_DB_FILE):
+    user_settings = {}
+    try:
+        conn = open_state_db()
+        try:
+            for uid, data in conn.execute("SELECT user_id, data FROM user_settings"):
+                user_settings[uid] = json.loads(data)
+            for uid, data in conn.execute("SELECT user_id, data FROM user_sessions"):
+                user_sessions[uid] = new_session(json.loads(data))
+        finally:
+            conn.close()
+    except (sqlite3.Error, ValueError) as e:
+        logger.error("Ошибка загрузки настроек: %s", e)
+    if not user_settings and SETTINGS_DB_FILE and os.path.exists(SETTINGS_DB_FILE):
         try:
             with open(SETTINGS_DB_FILE, "r", encoding="utf-8") as f:
                 user_settings = json.load(f)
+            dirty_state.update(("user_settings", uid) for uid in user_settings)
+            flush_state_db()
+            logger.info("Настройки перенесены из %s в %s", SETTINGS_DB_FILE, STATE_DB_FILE)
         except Exception as e:
             logger.error("Ошибка загрузки настроек: %s", e)
             user_settings = {}
-    else:
-        user_settings = {}
 
-# Сохранение настроек в файл
-def save_settings_db():
-    with open(SETTINGS_DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(user_settings, f, ensure_ascii=False, indent=2)
+# Снимок изменённых записей; сериализация в потоке цикла событий, пока данные не меняются
+def take_dirty_state():
+    rows = []
+    for table, uid in dirty_state:
+        data = state_store(table).get(uid)
+        if data is not None:
+            rows.append((table, uid, json.dumps(data, ensure_ascii=False)))
+    dirty_state.clear()
+    return rows
+
+def write_state_rows(rows):
+    with state_db_lock:
+        conn = open_state_db()
+        try:
+            with conn:
+                for table, uid, data in rows:
+                    conn.execute(
+                        f"INSERT INTO {table} (user_id, data) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                        (uid, data),
+                    )
+        finally:
+            conn.close()
+
+# Синхронный сброс всех изменений (при остановке и вне цикла событий)
+def flush_state_db():
+    global state_flush_handle
+    if state_flush_handle is not None:
+        state_flush_handle.cancel()
+        state_flush_handle = None
+    rows = take_dirty_state()
+    if rows:
+        write_state_rows(rows)
+
+async def flush_state_async():
+    global state_flush_handle
+    state_flush_handle = None
+    rows = take_dirty_state()
+    if not rows:
+        return
+    try:
+        await run_blocking("state", write_state_rows, rows)
+    except Exception as e:
+        logger.error("Ошибка сохранения настроек: %s", e)
+        dirty_state.update((table, uid) for table, uid, _ in rows)
+        schedule_state_flush()
+
+# Отложенный сброс: изменения за STATE_FLUSH_DELAY секунд записываются одной транзакцией
+def schedule_state_flush():
+    global state_flush_handle
+    if state_flush_handle is not None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        flush_state_db()
+        return
+    state_flush_handle = loop.call_later(STATE_FLUSH_DELAY, lambda: asyncio.ensure_future(flush_state_async()))
+
+# Сохранение настроек пользователя (отложенное)
+def save_settings_db(user_id):
+    dirty_state.add(("user_settings", str(user_id)))
+    schedule_state_flush()
+
+# Сессия пользователя: при первом обращении читается из базы, дальше живёт в памяти
+def new_session(data=None):
+    session = {"cwd": None, "history": [], "recent": []}
+    session.update(data or {})
+    return session
+
+# Сессии загружаются из базы при старте (load_settings_db), дальше живут в памяти
+# и сохраняются отложенной записью, так что обработчики не ходят в базу
+def get_session(user_id):
+    uid = str(user_id)
+    session = user_sessions.get(uid)
+    if session is None:
+        session = user_sessions[uid] = new_session()
+    return session
+
+# Существует ли ещё текущая директория: проверяется в пуле потоков перед каждой командой
+# (authorized_only), чтобы get_current_dir не обращался к диску из цикла событий
+current_dir_valid = {}
+
+def check_current_dir(user_id):
+    cwd = get_session(user_id)["cwd"]
+    current_dir_valid[str(user_id)] = bool(cwd) and os.path.isdir(cwd)
 
 # Получение текущей директории пользователя
 def get_current_dir(user_id):
-    return current_dirs.get(str(user_id), os.getcwd())
+    cwd = get_session(user_id)["cwd"]
+    if cwd and current_dir_valid.get(str(user_id), True):
+        return cwd
+    return os.getcwd()
+
+# Смена текущей директории с записью в историю (remember=False — без записи, для `cd -`)
+def set_current_dir(user_id, path, remember=True):
+    session = get_session(user_id)
+    previous = session["cwd"]
+    if remember and previous and previous != path:
+        session["history"] = (session["history"] + [previous])[-SESSION_HISTORY_SIZE:]
+    session["cwd"] = path
+    current_dir_valid[str(user_id)] = True
+    session["recent"] = ([path] + [p for p in session["recent"] if p != path])[:SESSION_HISTORY_SIZE]
+    dirty_state.add(("user_sessions", str(user_id)))
+    schedule_state_flush()
 
 # Получение настроек пользователя
 def get_user_settings(user_id):
@@ -107,25 +652,212 @@ def get_user_settings(user_id):
             "default_path": None,
             "filtering": "off",  # режимы: "off", "name", "date"
             "grouping": "off",  # режимы: "off", "date"
+            "page_size": None,  # записей на странице /ls; None — LS_PAGE_SIZE
         }
-        save_settings_db()
     return user_settings[uid]
 
+# Фоновая запись журнала действий: обработчики только кладут запись в очередь,
+# отдельный поток пишет пачками, ротирует файл и сбрасывает буфер при остановке.
+class ActionLogWriter:
+    def __init__(self, path, fsync=LOG_FSYNC, max_bytes=LOG_MAX_BYTES, rotate_interval=LOG_ROTATE_INTERVAL,
+                 backup_count=LOG_BACKUP_COUNT, compress=LOG_COMPRESS, echo=True, audit_path=None):
+        self.path = path
+        self.audit_path = audit_path
+        self.audit_conn = None
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.echo = echo
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.opened_at = 0.0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="action-log", daemon=True)
+        self.thread.start()
+
+    # Запись сериализуется сразу: словари деталей могут меняться после вызова
+    def write(self, entry, console_line=None):
+        if not self.closed:
+            self.queue.put((json.dumps(entry, ensure_ascii=False), console_line, entry))
+
+    def close(self, timeout=5):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            records = [item for item in batch if item is not None]
+            try:
+                self._write_batch(records)
+            except Exception as e:
+                logger.error("Ошибка логирования: %s", e)
+            if stop:
+                if self.file:
+                    self.file.close()
+                    self.file = None
+                if self.audit_conn:
+                    self.audit_conn.close()
+                    self.audit_conn = None
+                return
+
+    def _write_batch(self, records):
+        if self.echo:
+            lines = [line for _, line, _ in records if line]
+            if lines:
+                print("\n".join(lines), flush=True)
+        if not records:
+            return
+        if self.audit_path:
+            try:
+                if self.audit_conn is None:
+                    self.audit_conn = open_audit_db(self.audit_path)
+                insert_audit_rows(self.audit_conn, [(entry, line) for line, _, entry in records])
+            except sqlite3.Error as e:
+                logger.error("Ошибка записи в базу аудита: %s", e)
+        if not self.path:
+            return
+        self._maybe_rotate()
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.opened_at = time.time()
+        for line, _, _ in records:
+            self.file.write(line + "\n")
+            if self.fsync == "always":
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        self.file.flush()
+        if self.fsync == "batch":
+            os.fsync(self.file.fileno())
+
+    def _maybe_rotate(self):
+        if self.file is None:
+            return
+        too_big = self.max_bytes and self.file.tell() >= self.max_bytes
+        too_old = self.rotate_interval and time.time() - self.opened_at >= self.rotate_interval
+        if not (too_big or too_old):
+            return
+        self.file.close()
+        self.file = None
+        segment = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        os.replace(self.path, segment)
+        if self.compress:
+            with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(segment)
+        segments = sorted(glob.glob(glob.escape(self.path) + ".*"))
+        for old in segments[:max(0, len(segments) - self.backup_count)]:
+            os.remove(old)
+
+# База аудита: копия журнала действий с индексами по времени, пользователю и команде
+def open_audit_db(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS actions (
+            id INTEGER PRIMARY KEY, ts REAL, user_id INTEGER, command TEXT, entry TEXT
+        );
+        CREATE INDEX IF NOT EXISTS actions_ts ON actions(ts);
+        CREATE INDEX IF NOT EXISTS actions_user_ts ON actions(user_id, ts);
+        CREATE INDEX IF NOT EXISTS actions_command_ts ON actions(command, ts);
+    """)
+    return conn
+
+# Вставка записей [(словарь записи, JSON-строка)] одной транзакцией
+def insert_audit_rows(conn, records):
+    rows = []
+    for entry, line in records:
+        try:
+            ts = datetime.fromisoformat(entry["timestamp"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            continue
+        rows.append((ts, entry.get("user_id"), entry.get("command"), line))
+    with conn:
+        conn.executemany("INSERT INTO actions (ts, user_id, command, entry) VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+# Разовый импорт существующих JSONL-журналов (в том числе сжатых сегментов .gz)
+def import_action_logs(paths, audit_path=AUDIT_DB_FILE):
+    conn = open_audit_db(audit_path)
+    total = 0
+    try:
+        for path in paths:
+            opener = gzip.open if path.endswith(".gz") else open
+            batch = []
+            with opener(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        batch.append((json.loads(line), line))
+                    except json.JSONDecodeError:
+                        continue
+                    if len(batch) >= 10000:
+                        total += insert_audit_rows(conn, batch)
+                        batch = []
+            total += insert_audit_rows(conn, batch)
+    finally:
+        conn.close()
+    return total
+
+action_log = ActionLogWriter(LOG_FILE, audit_path=AUDIT_DB_FILE or None)
+atexit.register(action_log.close)
+debug_log = ActionLogWriter(DEBUG_LOG_FILE, echo=False) if DEBUG_LOG_FILE else None
+if debug_log:
+    atexit.register(debug_log.close)
+
+# Сокращение значения для журнала: длинные списки — число элементов и первые LOG_MAX_ITEMS,
+# длинные строки обрезаются, поля из LOG_HASHED_FIELDS заменяются хэшем
+def summarize_log_value(value, key=None):
+    if key in LOG_HASHED_FIELDS and isinstance(value, str):
+        data = value.encode("utf-8")
+        return {"sha256": hashlib.sha256(data).hexdigest(), "bytes": len(data)}
+    if isinstance(value, str):
+        if len(value) > LOG_MAX_FIELD_CHARS:
+            return value[:LOG_MAX_FIELD_CHARS] + f"… (+{len(value) - LOG_MAX_FIELD_CHARS})"
+        return value
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        if len(items) > LOG_MAX_ITEMS:
+            return {"count": len(items), "first": [summarize_log_value(v) for v in items[:LOG_MAX_ITEMS]]}
+        return [summarize_log_value(v) for v in items]
+    if isinstance(value, dict):
+        # Группы файлов по директориям (результаты поиска) сворачиваются в общий список путей
+        if value and all(isinstance(v, (list, tuple)) for v in value.values()):
+            paths = [os.path.join(d, f) for d, files in value.items() for f in files]
+            if len(paths) > LOG_MAX_ITEMS:
+                return {"count": len(paths), "dirs": len(value), "first": paths[:LOG_MAX_ITEMS]}
+        items = list(value.items())
+        summary = {k: summarize_log_value(v, k) for k, v in items[:LOG_MAX_ITEMS]}
+        if len(items) > LOG_MAX_ITEMS:
+            summary["…"] = f"+{len(items) - LOG_MAX_ITEMS}"
+        return summary
+    return value
+
 # Логирование действий
 def log_action(user_id, command, details):
     log_entry = {
         "timestamp": datetime.now().isoformat(),
         "user_id": user_id,
         "command": command,
-        "details": details,
+        "details": summarize_log_value(details),
     }
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{timestamp}] [User ID: {user_id}] - {command} {details}")
-    except Exception as e:
-        logger.error("Ошибка логирования: %s", e)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    action_log.write(log_entry, f"[{timestamp}] [User ID: {user_id}] - {command} {log_entry['details']}")
+    if debug_log:
+        debug_log.write(dict(log_entry, details=details))
 
 # Вспомогательная функция для отправки сообщений и логирования
 async def send_message_and_log(update: Update, text: str, command: str, details: dict):
@@ -154,16 +886,575 @@ def get_date_group(mod_time: float) -> str:
         return "В прошлом месяце"
     return "Давно"
 
+# Блокирующие операции с файловой системой (выполняются через run_blocking)
+
+def write_text_file(path, content):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+# Копирование (/cp). Сначала строится план: папки, файлы с размером и mtime, ссылки на папки.
+# Возвращает None, если источник не найден.
+def plan_copy(src_path, dst_path):
+    plan = {"dirs": [], "files": [], "links": []}
+    if os.path.isfile(src_path):
+        if os.path.isdir(dst_path):
+            dst_path = os.path.join(dst_path, os.path.basename(src_path))
+        st = os.stat(src_path)
+        plan["files"].append((src_path, dst_path, st.st_size, st.st_mtime))
+        return plan
+    if not os.path.isdir(src_path):
+        return None
+    if os.path.abspath(dst_path).startswith(os.path.join(os.path.abspath(src_path), "")):
+        raise ValueError("Нельзя скопировать папку внутрь самой себя")
+    stack = [(src_path, dst_path)]
+    while stack:
+        check_cancelled()
+        src_dir, dst_dir = stack.pop()
+        plan["dirs"].append((src_dir, dst_dir))
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                target = os.path.join(dst_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, target))
+                elif entry.is_symlink() and entry.is_dir():
+                    # Ссылка на папку переносится ссылкой, иначе возможны циклы
+                    plan["links"].append((entry.path, target))
+                else:
+                    st = entry.stat()
+                    plan["files"].append((entry.path, target, st.st_size, st.st_mtime))
+    return plan
+
+# HDD плохо переносит параллельное чтение (лишние перемещения головок), SSD — наоборот.
+# Тип диска берётся из /sys (Linux); None — определить не удалось.
+def is_rotational(path):
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    try:
+        st = os.stat(path)
+        base = f"/sys/dev/block/{os.major(st.st_dev)}:{os.minor(st.st_dev)}"
+        for candidate in (base + "/queue/rotational", base + "/../queue/rotational"):
+            if os.path.exists(candidate):
+                with open(candidate) as f:
+                    return f.read().strip() == "1"
+    except (OSError, AttributeError):
+        pass
+    return None
+
+def copy_worker_count(src_path, dst_path):
+    if COPY_WORKERS > 0:
+        return COPY_WORKERS
+    kinds = {is_rotational(src_path), is_rotational(dst_path)}
+    if True in kinds:
+        return 1
+    return 8 if kinds == {False} else 4
+
+def new_copy_progress(plan):
+    return {
+        "lock": threading.Lock(),
+        "started": time.monotonic(),
+        "total_bytes": sum(f[2] for f in plan["files"]),
+        "total_files": len(plan["files"]),
+        "bytes": 0,
+        "files": 0,
+        "skipped": 0,
+        "skipped_bytes": 0,
+        "errors": [],
+    }
+
+def add_copy_progress(progress, size=0, files=0, skipped=0):
+    with progress["lock"]:
+        progress["bytes"] += size
+        progress["files"] += files
+        progress["skipped"] += skipped
+        if skipped:
+            progress["skipped_bytes"] += size
+    report_job_progress(size, files + skipped)
+
+# Копирование данных файла средствами ядра: reflink (FICLONE), затем copy_file_range
+# и sendfile; если ни один не поддерживается — обычное чтение блоками
+FICLONE = 0x40049409
+FAST_COPY_FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+def copy_file_data(src, dst, progress):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        in_fd = fsrc.fileno()
+        out_fd = fdst.fileno()
+        size = os.fstat(in_fd).st_size
+        if fcntl is not None and size:
+            try:
+                fcntl.ioctl(out_fd, FICLONE, in_fd)
+                add_copy_progress(progress, size)
+                return
+            except OSError:
+                pass
+        offset = 0
+        for name in ("copy_file_range", "sendfile"):
+            if not hasattr(os, name) or (name == "sendfile" and not sys.platform.startswith("linux")):
+                continue
+            try:
+                while True:
+                    if name == "copy_file_range":
+                        n = os.copy_file_range(in_fd, out_fd, COPY_CHUNK_SIZE, offset, offset)
+                    else:
+                        n = os.sendfile(out_fd, in_fd, offset, COPY_CHUNK_SIZE)
+                    if not n:
+                        break
+                    offset += n
+                    add_copy_progress(progress, n)
+                    check_cancelled()
+            except OSError as e:
+                if offset or e.errno not in FAST_COPY_FALLBACK_ERRORS:
+                    raise
+            # Некоторые ФС (procfs, sysfs, часть FUSE и сетевых) сразу отвечают 0 байт:
+            # тогда, как и shutil, пробуем следующий способ и в конце обычное чтение
+            if offset and offset >= size:
+                return
+            if offset:
+                break
+        # Дочитываем с того места, где остановилось быстрое копирование
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        while True:
+            block = fsrc.read(COPY_CHUNK_SIZE)
+            if not block:
+                return
+            fdst.write(block)
+            add_copy_progress(progress, len(block))
+            check_cancelled()
+
+# Файл, уже скопированный прежде (тот же размер и mtime), пропускается: так прерванное
+# копирование продолжается с места остановки. mtime выставляется только после полной
+# записи, поэтому недописанный файл под это условие не попадает.
+def copy_one_file(src, dst, size, mtime, progress):
+    check_cancelled()
+    try:
+        st = os.stat(dst)
+        if st.st_size == size and abs(st.st_mtime - mtime) < 1:
+            add_copy_progress(progress, size, skipped=1)
+            return
+    except OSError:
+        pass
+    try:
+        copy_file_data(src, dst, progress)
+        shutil.copystat(src, dst)
+        add_copy_progress(progress, files=1)
+    except OSError as e:
+        with progress["lock"]:
+            progress["errors"].append(f"{src}: {e}")
+
+def create_copy_dirs(plan):
+    for _, dst_dir in plan["dirs"]:
+        os.makedirs(dst_dir, exist_ok=True)
+    for src, dst in plan["links"]:
+        if not os.path.lexists(dst):
+            os.symlink(os.readlink(src), dst)
+
+# Время изменения папок — в конце, когда их содержимое уже не меняется
+def copy_dirs_stat(plan):
+    for src_dir, dst_dir in reversed(plan["dirs"]):
+        try:
+            shutil.copystat(src_dir, dst_dir)
+        except OSError:
+            pass
+
+# Выполнение плана: файлы копируются в общем пуле потоков, не больше workers одновременно
+# и в пределах лимита команды cp. Первая ошибка, не обработанная в copy_one_file
+# (в том числе отмена задачи), останавливает копирование и передаётся вызывающему.
+async def run_copy(plan, progress, workers):
+    await run_blocking("cp", create_copy_dirs, plan)
+    files = iter(plan["files"])
+
+    async def worker():
+        for src, dst, size, mtime in files:
+            await run_blocking("cp", copy_one_file, src, dst, size, mtime, progress)
+
+    workers = max(1, min(workers, COMMAND_LIMITS.get("cp", DEFAULT_COMMAND_LIMIT), len(plan["files"])))
+    tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    await run_blocking("cp", copy_dirs_stat, plan)
+    return progress
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60:02d} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60:02d} с"
+    return f"{seconds} с"
+
+def format_copy_progress(title, progress):
+    elapsed = max(time.monotonic() - progress["started"], 0.001)
+    done = progress["bytes"]
+    total = progress["total_bytes"]
+    files = progress["files"] + progress["skipped"]
+    speed = done / elapsed
+    lines = [
+        title,
+        f"{human_size(done)} из {human_size(total)} ({done * 100 / total if total else 100:.0f}%), {human_size(speed)}/с",
+        f"Файлов: {files}/{progress['total_files']}, {files / elapsed:.1f} файл/с",
+    ]
+    if speed and done < total:
+        lines.append(f"Осталось: ~{format_duration((total - done) / speed)}")
+    return "\n".join(lines)
+
+# Возвращает False, если цель не найдена
+def remove_path(target_path):
+    if os.path.islink(target_path) or os.path.isfile(target_path):
+        os.remove(target_path)
+    elif os.path.isdir(target_path):
+        # Снизу вверх, с проверкой отмены после каждой папки
+        for root, dirs, files in os.walk(target_path, topdown=False):
+            check_cancelled()
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.remove(path)
+                else:
+                    os.rmdir(path)
+            report_job_progress(files=len(files))
+        os.rmdir(target_path)
+    else:
+        return False
+    return True
+
+# Копирование одного файла при перемещении между файловыми системами
+def cancellable_copy2(src, dst):
+    check_cancelled()
+    result = shutil.copy2(src, dst)
+    report_job_progress(os.path.getsize(dst), 1)
+    return result
+
 # Декоратор для проверки прав доступа
+# Метрики и профиль снимаются здесь же, для каждой команды
 def authorized_only(func):
+    command = re.sub(r"_(command|file|job)$", "", func.__name__)
+
     async def wrapper(update: Update, context: CallbackContext):
         if update.effective_user.id != AUTHORIZED_USER_ID:
-            await update.message.reply_text("Нет доступа.")
+            await update.effective_message.reply_text("Нет доступа.")
             return
-        return await func(update, context)
+        stats = current_stats.get()
+        if stats is not None:
+            # Вложенный вызов (текстовая команда без слеша): учитываем под именем команды
+            stats["command"] = command
+            return await func(update, context)
+        stats = begin_command_stats(command)
+        token = current_stats.set(stats)
+        failed = False
+        try:
+            await run_blocking("session", check_current_dir, update.effective_user.id)
+            return await func(update, context)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            current_stats.reset(token)
+            if not stats["detached"]:
+                finish_command_stats(stats, failed)
 
     return wrapper
 
+def begin_command_stats(command):
+    stats = {
+        "command": command,
+        "started": time.perf_counter(),
+        "io_wait": 0.0,
+        "read_bytes": 0,
+        "write_bytes": 0,
+        "messages": 0,
+        "detached": False,
+        "profile": None,
+    }
+    if PROFILE_SLOW_MS > 0:
+        start_profile(stats)
+    return stats
+
+def finish_command_stats(stats, failed=False):
+    elapsed = time.perf_counter() - stats["started"]
+    if stats["profile"] is not None:
+        stop_profile(stats, elapsed)
+    with stats_lock:
+        entry = command_stats.get(stats["command"])
+        if entry is None:
+            entry = command_stats[stats["command"]] = {
+                "count": 0, "errors": 0, "sum": 0.0, "buckets": [0] * (len(STATS_BUCKETS) + 1),
+                "recent": deque(maxlen=STATS_WINDOW), "io_wait": 0.0, "read_bytes": 0, "write_bytes": 0,
+                "messages": 0,
+            }
+        entry["count"] += 1
+        entry["errors"] += failed
+        entry["sum"] += elapsed
+        entry["buckets"][bisect.bisect_left(STATS_BUCKETS, elapsed)] += 1
+        entry["recent"].append(elapsed)
+        for key in ("io_wait", "read_bytes", "write_bytes", "messages"):
+            entry[key] += stats[key]
+
+# Сэмплирующий профилировщик: один поток на все профилируемые команды. Снимаются стеки
+# потока цикла событий и потоков пула, пока они выполняют работу этой команды.
+active_profiles = {}
+profiler_thread = None
+PROFILE_IDLE_FUNCTIONS = {"select", "poll"}
+
+def start_profile(stats):
+    global profiler_thread
+    stats["profile"] = Counter()
+    stats["threads"] = {threading.get_ident(): 1}
+    with stats_lock:
+        active_profiles[id(stats)] = stats
+        if profiler_thread is None:
+            profiler_thread = threading.Thread(target=profiler_loop, name="profiler", daemon=True)
+            profiler_thread.start()
+
+def profiler_loop():
+    global profiler_thread
+    me = threading.get_ident()
+    while True:
+        with stats_lock:
+            if not active_profiles:
+                profiler_thread = None
+                return
+            profiles = [(stats["profile"], set(stats["threads"])) for stats in active_profiles.values()]
+        frames = sys._current_frames()
+        stacks = {}
+        for profile, threads in profiles:
+            for ident in threads:
+                # Собственный поток профилировщика в сэмплы не попадает
+                if ident == me:
+                    continue
+                frame = frames.get(ident)
+                if frame is None or frame.f_code.co_name in PROFILE_IDLE_FUNCTIONS:
+                    continue
+                if ident not in stacks:
+                    stack = []
+                    while frame is not None and len(stack) < 16:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                        frame = frame.f_back
+                    stacks[ident] = ";".join(reversed(stack))
+                profile[stacks[ident]] += 1
+        time.sleep(PROFILE_INTERVAL)
+
+# Стеки пишутся в «свёрнутом» формате (как для flamegraph.pl): стек и число сэмплов
+def stop_profile(stats, elapsed):
+    with stats_lock:
+        active_profiles.pop(id(stats), None)
+    profile = stats["profile"]
+    if not profile or elapsed * 1000 < PROFILE_SLOW_MS:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{stats['command']}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in profile.most_common(50):
+                f.write(f"{stack} {count}\n")
+        logger.warning("Медленная команда %s: %.0f мс, профиль: %s", stats["command"], elapsed * 1000, path)
+    except OSError as e:
+        logger.error("Ошибка записи профиля: %s", e)
+
+# Ограничение частоты исходящих сообщений: ведро токенов на каждый чат и общее на бота
+# (Telegram допускает около 1 сообщения в секунду в чат и 30 в секунду всего)
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "5"))
+
+# Вывод длиннее этого числа символов отправляется одним .txt-файлом вместо сообщений
+SEND_DOCUMENT_THRESHOLD = int(os.getenv("SEND_DOCUMENT_THRESHOLD", "16000"))
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # После RetryAfter ведро закрыто на указанное время, накопленные токены сгорают
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+send_buckets = {}
+global_send_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+
+def get_send_bucket(chat_id):
+    if chat_id not in send_buckets:
+        send_buckets[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+    return send_buckets[chat_id]
+
+# Все запросы к Telegram проходят здесь: отправка и правка сообщений ждут токенов своего чата
+# и общего ведра, ответ 429 (RetryAfter) повторяется после паузы. Заодно запросы учитываются
+# в метриках команды.
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        if not api_method.startswith(("send", "edit")):
+            return await super().do_request(url, method, request_data, **kwargs)
+        add_stats(messages=1)
+        chat_id = request_data.parameters.get("chat_id") if request_data is not None else None
+        bucket = get_send_bucket(chat_id)
+        for attempt in range(SEND_RETRIES):
+            await bucket.acquire()
+            await global_send_bucket.acquire()
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+            if code != 429 or attempt == SEND_RETRIES - 1:
+                return code, payload
+            try:
+                retry_after = float(json.loads(payload)["parameters"]["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                retry_after = 2.0 ** attempt
+            logger.warning("Telegram просит подождать %.0f с (%s, чат %s)", retry_after, api_method, chat_id)
+            bucket.pause(retry_after)
+        return code, payload
+
+# Буфер ответов одной команды. Мелкие сообщения склеиваются в одно (до 4096 символов),
+# а если весь вывод длиннее SEND_DOCUMENT_THRESHOLD, остаток уходит одним .txt-файлом.
+class Outbox:
+    def __init__(self, update, filename, parse_mode=None):
+        self.update = update
+        self.filename = filename
+        self.parse_mode = parse_mode
+        self.pending = []
+        self.pending_plain = []
+        self.sent_chars = 0
+        self.document_mode = False
+
+    # messages — готовые части (каждая не длиннее 4096), plain — тот же вывод простым текстом
+    def add(self, messages, plain):
+        self.pending.extend(messages)
+        self.pending_plain.append(plain)
+
+    async def flush(self):
+        if not self.document_mode:
+            pending_chars = sum(len(m) for m in self.pending)
+            if self.sent_chars + pending_chars > SEND_DOCUMENT_THRESHOLD:
+                self.document_mode = True
+        if self.document_mode:
+            self.pending = []
+            return
+        buffer = ""
+        for message in self.pending:
+            if buffer and len(buffer) + len(message) + 1 > 4096:
+                await self.update.message.reply_text(buffer, parse_mode=self.parse_mode)
+                buffer = ""
+            buffer = f"{buffer}\n{message}" if buffer else message
+        if buffer:
+            await self.update.message.reply_text(buffer, parse_mode=self.parse_mode)
+        self.sent_chars += sum(len(m) for m in self.pending)
+        self.pending = []
+        self.pending_plain = []
+
+    async def close(self):
+        await self.flush()
+        if self.document_mode and self.pending_plain:
+            data = "\n".join(self.pending_plain).encode("utf-8")
+            caption = "Вывод слишком большой для сообщений, отправлен файлом"
+            if self.sent_chars:
+                caption = "Продолжение вывода — в файле"
+            await self.update.message.reply_document(document=data, filename=self.filename, caption=caption)
+            self.pending_plain = []
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def render_prometheus():
+    with stats_lock:
+        snapshot = {name: dict(entry, buckets=list(entry["buckets"])) for name, entry in command_stats.items()}
+    lines = [
+        "# HELP filemanager_command_duration_seconds Время выполнения команд",
+        "# TYPE filemanager_command_duration_seconds histogram",
+    ]
+    for name, entry in sorted(snapshot.items()):
+        cumulative = 0
+        for bound, count in zip(STATS_BUCKETS + ("+Inf",), entry["buckets"]):
+            cumulative += count
+            lines.append(f'filemanager_command_duration_seconds_bucket{{command="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'filemanager_command_duration_seconds_sum{{command="{name}"}} {entry["sum"]:.6f}')
+        lines.append(f'filemanager_command_duration_seconds_count{{command="{name}"}} {entry["count"]}')
+    counters = (
+        ("io_wait", "filemanager_command_io_wait_seconds_total", "Время ожидания пулов потоков и процессов"),
+        ("read_bytes", "filemanager_command_read_bytes_total", "Прочитано байт"),
+        ("write_bytes", "filemanager_command_written_bytes_total", "Записано байт"),
+        ("messages", "filemanager_command_messages_total", "Отправлено и изменено сообщений"),
+        ("errors", "filemanager_command_errors_total", "Команды, завершившиеся исключением"),
+    )
+    for key, metric, description in counters:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, entry in sorted(snapshot.items()):
+            lines.append(f'{metric}{{command="{name}"}} {entry[key]}')
+    return "\n".join(lines) + "\n"
+
+def write_prometheus_file():
+    tmp_path = STATS_PROMETHEUS_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, STATS_PROMETHEUS_FILE)
+
+async def export_stats_file():
+    while True:
+        await asyncio.sleep(STATS_EXPORT_INTERVAL)
+        try:
+            await asyncio.get_running_loop().run_in_executor(io_executor, write_prometheus_file)
+        except OSError as e:
+            logger.error("Ошибка записи метрик: %s", e)
+
+async def serve_stats_request(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        body = render_prometheus().encode("utf-8")
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+stats_exporters = []
+
+async def start_stats_exporters():
+    if STATS_PROMETHEUS_FILE:
+        stats_exporters.append(asyncio.create_task(export_stats_file()))
+    if STATS_PROMETHEUS_PORT:
+        server = await asyncio.start_server(serve_stats_request, "127.0.0.1", STATS_PROMETHEUS_PORT)
+        stats_exporters.append(server)
+
+def stop_stats_exporters():
+    for exporter in stats_exporters:
+        if isinstance(exporter, asyncio.Task):
+            exporter.cancel()
+        else:
+            exporter.close()
+    stats_exporters.clear()
+    if STATS_PROMETHEUS_FILE:
+        try:
+            write_prometheus_file()
+        except OSError as e:
+            logger.error("Ошибка записи метрик: %s", e)
+
 # Команда /create
 @authorized_only
 async def create_file(update: Update, context: CallbackContext) -> None:
@@ -176,8 +1467,8 @@ async def create_file(update: Update, context: CallbackContext) -> None:
     current_dir = get_current_dir(user_id)
     full_path = os.path.join(current_dir, file_name)
     try:
-        with open(full_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        await run_blocking("create", write_text_file, full_path, content)
+        invalidate_index()
         await send_message_and_log(update, f"Файл создан: {file_name}", "create", {"file": full_path, "content": content})
     except Exception as e:
         await send_message_and_log(update, f"Ошибка создания файла: {e}", "create", {"error": str(e), "file": full_path})
@@ -193,71 +1484,974 @@ async def edit_file(update: Update, context: CallbackContext) -> None:
     content = "\n".join(context.args[1:])  # Сохраняем переносы строк
     current_dir = get_current_dir(user_id)
     full_path = os.path.join(current_dir, file_name)
-    if not os.path.isfile(full_path):
+    if not await run_blocking("edit", os.path.isfile, full_path):
         await update.message.reply_text("Файл не найден.")
         return
     try:
-        with open(full_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        await run_blocking("edit", write_text_file, full_path, content)
+        invalidate_index()
         await update.message.reply_text(f"Файл отредактирован: {file_name}")
         log_action(user_id, "edit", {"file": full_path, "content": content})
     except Exception as e:
         await update.message.reply_text(f"Ошибка редактирования файла: {e}")
         log_action(user_id, "edit", {"error": str(e), "file": full_path})
 
+# Разреженный индекс строк для /view: каждые VIEW_INDEX_STEP байт запоминается смещение
+# и число переводов строк до него. Кэшируется по (путь, mtime, размер).
+line_index_cache = OrderedDict()
+line_index_lock = threading.Lock()
+
+def get_line_index(path):
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with line_index_lock:
+        if key in line_index_cache:
+            line_index_cache.move_to_end(key)
+            return line_index_cache[key]
+    offsets = [0]
+    lines = [0]
+    newlines = 0
+    last_byte = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(VIEW_INDEX_STEP)
+            if not chunk:
+                break
+            newlines += chunk.count(b"\n")
+            offsets.append(offsets[-1] + len(chunk))
+            lines.append(newlines)
+            last_byte = chunk[-1:]
+    size = offsets[-1]
+    index = {
+        "offsets": offsets,
+        "lines": lines,
+        "size": size,
+        "total_lines": newlines + (1 if size and last_byte != b"\n" else 0),
+    }
+    with line_index_lock:
+        line_index_cache[key] = index
+        while len(line_index_cache) > 32:
+            line_index_cache.popitem(last=False)
+    return index
+
+# Смещение начала строки n (с нуля): от ближайшей контрольной точки до n
+def line_start(mm, index, n):
+    if n <= 0:
+        return 0
+    i = bisect.bisect_left(index["lines"], n) - 1
+    pos = index["offsets"][i]
+    for _ in range(n - index["lines"][i]):
+        pos = mm.find(b"\n", pos)
+        if pos == -1:
+            return index["size"]
+        pos += 1
+    return pos
+
+# Номер строки (с нуля), в которой лежит байт offset
+def line_number_at(mm, index, offset):
+    i = bisect.bisect_right(index["offsets"], offset) - 1
+    return index["lines"][i] + mm[index["offsets"][i]:offset].count(b"\n")
+
+def decode_view_line(mm, start, end):
+    data = mm[start:min(end, start + VIEW_MAX_LINE_LENGTH * 4)]
+    text = data.decode("utf-8", errors="replace").rstrip("\r")
+    if len(text) > VIEW_MAX_LINE_LENGTH or end - start > len(data):
+        text = text[:VIEW_MAX_LINE_LENGTH] + "…"
+    return text
+
+# Поиск для /view --grep без учёта регистра. ASCII-шаблон ищется прямо по байтам файла;
+# для остальных (кириллица и т.п.) байтовый IGNORECASE не работает, поэтому файл
+# декодируется блоками целых строк и ищется str-шаблоном. Возвращает смещение совпадения.
+def compile_view_grep(grep):
+    if grep.isascii():
+        pattern = re.compile(grep.encode("utf-8"), re.IGNORECASE)
+
+        def find(mm, pos):
+            match = pattern.search(mm, pos)
+            return match.start() if match else None
+        return find
+    pattern = re.compile(grep, re.IGNORECASE)
+
+    def find(mm, pos):
+        size = len(mm)
+        while pos < size:
+            block_end = mm.find(b"\n", min(pos + VIEW_INDEX_STEP, size))
+            block_end = size if block_end == -1 else block_end + 1
+            # surrogateescape: длина совпадения в байтах восстанавливается точно
+            text = mm[pos:block_end].decode("utf-8", errors="surrogateescape")
+            match = pattern.search(text)
+            if match:
+                return pos + len(text[:match.start()].encode("utf-8", errors="surrogateescape"))
+            pos = block_end
+        return None
+    return find
+
+# Чтение одной страницы (выполняется в пуле потоков). Читаются только нужные строки.
+# Возвращает строки [(номер, текст)], начало следующей страницы (или None) и число строк.
+def read_view_page(path, start, page_lines, grep=None):
+    index = get_line_index(path)
+    total = index["total_lines"]
+    if not index["size"]:
+        return [], None, total
+    page = []
+    chars = 0
+    next_start = None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = line_start(mm, index, start)
+        if grep is None:
+            n = start
+            while n < total and len(page) < page_lines and chars < VIEW_MAX_PAGE_CHARS:
+                end = mm.find(b"\n", pos)
+                end = index["size"] if end == -1 else end
+                text = decode_view_line(mm, pos, end)
+                page.append((n, text))
+                chars += len(text) + 1
+                pos = end + 1
+                n += 1
+            if n < total:
+                next_start = n
+        else:
+            find = compile_view_grep(grep)
+            while len(page) < page_lines and chars < VIEW_MAX_PAGE_CHARS:
+                found = find(mm, pos)
+                if found is None:
+                    break
+                begin = mm.rfind(b"\n", 0, found) + 1
+                end = mm.find(b"\n", found)
+                end = index["size"] if end == -1 else end
+                n = line_number_at(mm, index, begin)
+                text = decode_view_line(mm, begin, end)
+                page.append((n, text))
+                chars += len(text) + 8
+                pos = end + 1
+            # Кнопка "дальше" нужна, только если после страницы есть ещё совпадения
+            if page and pos < index["size"] and find(mm, pos) is not None:
+                next_start = page[-1][0] + 1
+    return page, next_start, total
+
+# Последние count строк файла (выполняется в пуле потоков). Файл читается блоками с конца,
+# пока не наберётся достаточно переводов строк, так что размер файла на время не влияет.
+# Возвращает строки, смещение первой из них, размер файла на момент чтения и байты последней
+# строки, если она ещё не завершена переводом строки (иначе b"").
+def read_last_lines(path, count, block_size=64 * 1024):
+    max_bytes = count * VIEW_MAX_LINE_LENGTH * 4 + block_size
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        pos = size
+        data = b""
+        while pos > 0 and len(data) < max_bytes:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+            # Завершающий перевод строки не начинает новую строку
+            if data.count(b"\n", 0, len(data) - 1) >= count:
+                break
+    if not data:
+        return [], 0, size, b""
+    trailing = data.endswith(b"\n")
+    lines = (data[:-1] if trailing else data).split(b"\n")[-count:]
+    start = size - sum(len(line) + 1 for line in lines) - (0 if trailing else -1)
+    partial = b"" if trailing else lines[-1]
+    return [decode_view_line(line, 0, len(line)) for line in lines], max(0, start), size, partial
+
+# Экранирование текста внутри блока кода для MarkdownV2
+def escape_code_v2(text):
+    return text.replace("\\", "\\\\").replace("`", "\\`")
+
+# Сессии постраничного просмотра по пользователям (для кнопок навигации)
+view_sessions = {}
+
+# Отрисовка страницы сессии: текст для MarkdownV2 и клавиатура навигации
+async def render_view_page(session, start):
+    page, next_start, total = await run_blocking(
+        "view", read_view_page, session["path"], start, session["page_lines"], session["grep"]
+    )
+    starts = session["starts"]
+    if start not in starts:
+        starts.append(start)
+        starts.sort()
+    if session["grep"] is None:
+        prev_start = max(0, start - session["page_lines"]) if start > 0 else None
+    else:
+        position = starts.index(start)
+        prev_start = starts[position - 1] if position > 0 else None
+    # Экранирование может удлинить текст сверх лимита: тогда последние строки уходят
+    # на следующую страницу, а не обрезаются посреди экранированной последовательности
+    while True:
+        if session["grep"] is None:
+            if page:
+                header = f"{session['file_name']} — строки {page[0][0] + 1}–{page[-1][0] + 1} из {total}"
+            else:
+                header = f"{session['file_name']} — пусто"
+            body = "\n".join(text for _, text in page)
+        else:
+            header = f"{session['file_name']} — совпадения «{session['grep']}»"
+            if not page:
+                header += ": больше нет"
+            body = "\n".join(f"{n + 1}: {text}" for n, text in page)
+        text = f"{escape_markdown_v2(header)}\n```\n{escape_code_v2(body)}\n```"
+        if len(text) <= 4096 or len(page) <= 1:
+            break
+        next_start = page.pop()[0]
+    buttons = []
+    if prev_start is not None:
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"view:{prev_start}"))
+    if next_start is not None:
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"view:{next_start}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def render_view_tail(session):
+    lines, offset, _, _ = await run_blocking("view", read_last_lines, session["path"], session["page_lines"])
+    header = f"{session['file_name']} — последние строки: {len(lines)}" if lines else f"{session['file_name']} — пусто"
+    text = render_tail_text(header, lines)
+    markup = None
+    if offset > 0:
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("◀", callback_data="view:tail")]])
+    return text, markup
+
 # Команда /view
 @authorized_only
 async def view_file(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    if not context.args:
-        await update.message.reply_text("Использование: /view <имя_файла>")
+    usage = "Использование: /view <имя_файла> [--page=N] [--lines=a:b] [--tail=N] [--grep=шаблон]"
+    args = []
+    page = None
+    lines = None
+    tail = None
+    grep = None
+    try:
+        for arg in context.args:
+            if arg.startswith("--page="):
+                page = max(1, int(arg.split("=", 1)[1]))
+            elif arg.startswith("--lines="):
+                a, _, b = arg.split("=", 1)[1].partition(":")
+                lines = (max(1, int(a)), int(b) if b else None)
+            elif arg.startswith("--tail="):
+                tail = max(1, int(arg.split("=", 1)[1]))
+            elif arg.startswith("--grep="):
+                grep = arg.split("=", 1)[1]
+            else:
+                args.append(arg)
+    except ValueError:
+        await update.message.reply_text(usage)
         return
-    file_name = ' '.join(context.args)
+    if not args:
+        await update.message.reply_text(usage)
+        return
+    file_name = ' '.join(args)
     current_dir = get_current_dir(user_id)
     full_path = os.path.join(current_dir, file_name)
-    if not os.path.isfile(full_path):
+    if not await run_blocking("view", os.path.isfile, full_path):
         await update.message.reply_text("Файл не найден.")
         return
     try:
-        with open(full_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        # Разбиение текста на части
-        MAX_MESSAGE_LENGTH = 4096
-        messages = []
-        buffer = ""
-        lines = content.split("\n")
-        for line in lines:
-            escaped_line = escape_markdown_v2(line)  # Экранируем строку
-            if len(buffer) + len(escaped_line) + 1 > MAX_MESSAGE_LENGTH:
-                if buffer.startswith("```") and not buffer.endswith("```"):
-                    buffer += "\n```"  # Закрываем блок, если он открыт
+        if grep is not None:
+            re.compile(grep)
+        session = {"path": full_path, "file_name": file_name, "page_lines": VIEW_PAGE_LINES, "grep": grep, "starts": []}
+        start = 0
+        if lines:
+            start = lines[0] - 1
+            if lines[1]:
+                session["page_lines"] = max(1, lines[1] - lines[0] + 1)
+        elif tail and grep is not None:
+            index = await run_blocking("view", get_line_index, full_path)
+            start = max(0, index["total_lines"] - tail)
+            session["page_lines"] = tail
+        elif page:
+            start = (page - 1) * VIEW_PAGE_LINES
+        if tail and grep is None:
+            # Хвост читается с конца файла, индекс строк строится, только если листать назад
+            session["page_lines"] = tail
+            text, markup = await render_view_tail(session)
+            start = "tail"
+        else:
+            text, markup = await render_view_page(session, start)
+        view_sessions[str(user_id)] = session
+        await update.message.reply_text(text, parse_mode="MarkdownV2", reply_markup=markup)
+        log_action(user_id, "view", {"file": full_path, "start": start, "grep": grep})
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка просмотра файла: {e}")
+        log_action(user_id, "view", {"error": str(e), "file": full_path})
+
+# Кнопки навигации /view
+@authorized_only
+async def view_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    session = view_sessions.get(str(update.effective_user.id))
+    if not session:
+        await query.answer("Сессия просмотра устарела, откройте файл заново.")
+        return
+    try:
+        start = query.data.split(":", 1)[1]
+        if start == "tail":
+            # Страница перед хвостом: тут уже нужны номера строк
+            index = await run_blocking("view", get_line_index, session["path"])
+            start = max(0, index["total_lines"] - 2 * session["page_lines"])
+        text, markup = await render_view_page(session, int(start))
+        await query.answer()
+        await query.edit_message_text(text, parse_mode="MarkdownV2", reply_markup=markup)
+    except Exception as e:
+        await query.answer(f"Ошибка просмотра файла: {e}")
+
+# Слежение за файлами (/tail -f). На каждый файл — один наблюдатель, который опрашивает
+# размер и inode и раз в TAIL_EDIT_INTERVAL правит сообщения всех подписчиков.
+tail_watchers = {}
+
+# Чтение дописанного в файл с позиции state (выполняется в пуле потоков).
+# При ротации (сменился inode) или усечении файл читается с начала.
+def read_appended_lines(path, state):
+    st = os.stat(path)
+    if st.st_ino != state["inode"] or st.st_size < state["offset"]:
+        state.update(inode=st.st_ino, offset=0, partial=b"")
+    if st.st_size == state["offset"]:
+        return []
+    # Если дописано слишком много, показываем только хвост
+    offset = max(state["offset"], st.st_size - 1024 * 1024)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(st.st_size - offset)
+    if offset != state["offset"]:
+        state["partial"] = b""
+    state["offset"] = offset + len(data)
+    data = state["partial"] + data
+    lines = data.split(b"\n")
+    state["partial"] = lines.pop()
+    return [decode_view_line(line, 0, len(line)) for line in lines]
+
+def render_tail_text(title, lines):
+    header = escape_markdown_v2(title)
+    lines = list(lines)
+    while True:
+        text = f"{header}\n```\n{escape_code_v2(chr(10).join(lines))}\n```"
+        if len(text) <= 4096 or not lines:
+            return text
+        lines.pop(0)
+
+async def edit_tail_subscribers(watcher, bot):
+    text = render_tail_text(watcher["title"], watcher["lines"])
+    for key in list(watcher["subscribers"]):
+        chat_id, message_id = key
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode="MarkdownV2")
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                # Сообщение удалено или недоступно — подписка больше не нужна
+                watcher["subscribers"].pop(key, None)
+        except TelegramError as e:
+            logger.warning("Ошибка обновления tail: %s", e)
+
+async def follow_file(path, bot):
+    watcher = tail_watchers[path]
+    last_edit = 0.0
+    dirty = False
+    try:
+        while watcher["subscribers"]:
+            await asyncio.sleep(TAIL_POLL_INTERVAL)
+            try:
+                new_lines = await run_blocking("tail", read_appended_lines, path, watcher["state"])
+            except OSError:
+                new_lines = []  # Файл временно отсутствует (например, во время ротации)
+            if new_lines:
+                watcher["lines"].extend(new_lines)
+                dirty = True
+            if dirty and time.monotonic() - last_edit >= TAIL_EDIT_INTERVAL:
+                await edit_tail_subscribers(watcher, bot)
+                last_edit = time.monotonic()
+                dirty = False
+    finally:
+        tail_watchers.pop(path, None)
+
+def stop_tail_watchers():
+    for watcher in list(tail_watchers.values()):
+        watcher["task"].cancel()
+
+# Команда /tail
+@authorized_only
+async def tail(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    usage = "Использование: /tail <имя_файла> [-n N] [-f]"
+    args = list(context.args)
+    follow = "-f" in args
+    args = [a for a in args if a != "-f"]
+    count = TAIL_LINES
+    if "-n" in args:
+        i = args.index("-n")
+        try:
+            count = max(1, int(args[i + 1]))
+        except (IndexError, ValueError):
+            await update.message.reply_text(usage)
+            return
+        del args[i:i + 2]
+    if not args:
+        await update.message.reply_text(usage)
+        return
+    file_name = ' '.join(args)
+    full_path = os.path.normpath(os.path.join(get_current_dir(user_id), file_name))
+    if not await run_blocking("tail", os.path.isfile, full_path):
+        await update.message.reply_text("Файл не найден.")
+        return
+    try:
+        lines, _, size, partial = await run_blocking("tail", read_last_lines, full_path, count)
+        if not follow:
+            text = render_tail_text(f"{file_name} — последние строки: {len(lines)}", lines)
+            await update.message.reply_text(text, parse_mode="MarkdownV2")
+            log_action(user_id, "tail", {"file": full_path, "lines": count})
+            return
+        # Незавершённая последняя строка ждёт в буфере наблюдателя, пока не придёт её конец
+        if partial:
+            lines = lines[:-1]
+        title = f"{file_name} — tail -f"
+        message = await update.message.reply_text(render_tail_text(title, lines), parse_mode="MarkdownV2")
+        watcher = tail_watchers.get(full_path)
+        if watcher is None:
+            st = await run_blocking("tail", os.stat, full_path)
+            watcher = {
+                "title": title,
+                "lines": deque(lines, maxlen=max(count, TAIL_LINES)),
+                "state": {"inode": st.st_ino, "offset": size, "partial": partial},
+                "subscribers": {},
+            }
+            tail_watchers[full_path] = watcher
+            watcher["subscribers"][(message.chat_id, message.message_id)] = user_id
+            watcher["task"] = asyncio.create_task(follow_file(full_path, context.bot))
+        else:
+            watcher["subscribers"][(message.chat_id, message.message_id)] = user_id
+        log_action(user_id, "tail", {"file": full_path, "follow": True})
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка чтения файла: {e}")
+        log_action(user_id, "tail", {"error": str(e), "file": full_path})
+
+# Команда /untail
+@authorized_only
+async def untail(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    target = None
+    if context.args:
+        target = os.path.normpath(os.path.join(get_current_dir(user_id), ' '.join(context.args)))
+    stopped = 0
+    for path, watcher in list(tail_watchers.items()):
+        if target and path != target:
+            continue
+        for key, owner in list(watcher["subscribers"].items()):
+            if owner == user_id:
+                del watcher["subscribers"][key]
+                stopped += 1
+        # Наблюдатель без подписчиков завершится сам на следующей итерации
+    if stopped:
+        await update.message.reply_text(f"Слежение остановлено: {stopped}")
+    else:
+        await update.message.reply_text("Нет активных слежений.")
+    log_action(user_id, "untail", {"file": target, "stopped": stopped})
+
+def escape_markdown_v2(text):
+    """
+    Экранирует все зарезервированные символы для MarkdownV2.
+    """
+    reserved_chars = r"_*[]()~`>#+-=|{}.!"
+    return re.sub(f"([{re.escape(reserved_chars)}])", r"\\\1", text)
+
+def is_excluded(name, excludes):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in excludes)
+
+# Обход дерева на os.scandir с настоящим ограничением глубины (0 — только сама top).
+# Поддиректории глубже depth и подходящие под excludes не читаются вовсе, при follow_symlinks
+# уже посещённые директории (по st_dev/st_ino) пропускаются, чтобы не зациклиться.
+# После max_files файлов обход прекращается. Выдаёт (директория, список имён файлов).
+def walk_tree(top, depth=1000, excludes=(), max_files=None, follow_symlinks=False):
+    visited = set()
+    stack = [(top, 0)]
+    remaining = max_files
+    while stack:
+        check_cancelled()
+        path, level = stack.pop()
+        if follow_symlinks:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if excludes and is_excluded(entry.name, excludes):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            if level < depth:
+                                subdirs.append(entry.path)
+                        elif not entry.is_dir():
+                            files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+        if remaining is not None:
+            files = files[:remaining]
+            remaining -= len(files)
+        yield path, files
+        if remaining == 0:
+            return
+        stack.extend((subdir, level + 1) for subdir in reversed(subdirs))
+
+# Путь исключён, если под excludes подходит любая его часть ниже current_dir
+def path_excluded(path, current_dir, excludes):
+    rel = os.path.relpath(path, current_dir)
+    return rel != "." and any(is_excluded(part, excludes) for part in rel.split(os.sep))
+
+# Рекурсивный поиск файлов по имени (выполняется в пуле потоков).
+# Если нужен поиск по содержимому, остальные файлы возвращаются как кандидаты для сканирования.
+# После limit совпадений по имени обход прекращается.
+def find_files(current_dir, matcher, depth, file_type, content_search,
+               excludes=(), max_files=None, follow_symlinks=False, limit=None):
+    results = {}
+    candidates = []
+    found = 0
+    for root, files in walk_tree(current_dir, depth, excludes, max_files, follow_symlinks):
+        for file in files:
+            # Пропускаем файлы, не соответствующие типу
+            if file_type and not file.endswith(f".{file_type}"):
+                continue
+            # Проверка имени (маска, подстрока или регулярное выражение)
+            if matcher.match(file):
+                results.setdefault(root, []).append(file)
+                found += 1
+                if limit and found >= limit:
+                    return results, candidates
+            # Поиск по содержимому файла
+            elif content_search:
+                candidates.append(os.path.join(root, file))
+    return results, candidates
+
+# Разбор шаблонов имени: несколько шаблонов через пробел, имена с пробелами — в кавычках
+def split_search_patterns(query):
+    try:
+        patterns = shlex.split(query)
+    except ValueError:
+        patterns = query.split()
+    return patterns or [""]
+
+# Компиляция запроса в одно регулярное выражение для всех шаблонов сразу.
+# Маска переводится в regex, подстрока экранируется, регистр учитывается один раз флагом.
+def compile_search_query(patterns, regex_mode):
+    alternatives = []
+    for pattern in patterns:
+        if regex_mode:
+            alternatives.append(f"(?:{pattern})")
+        else:
+            alternatives.append(f"(?:{fnmatch.translate(pattern)})|(?s:.*?{re.escape(pattern)})")
+    return compile_regex("|".join(alternatives))
+
+# Сортировка результатов поиска (для date нужен stat каждого файла)
+def sort_search_results(results, sort_by):
+    sorted_results = {}
+    for directory, files in results.items():
+        if sort_by == "date":
+            sorted_files = sorted(
+                files,
+                key=lambda x: os.path.getmtime(os.path.join(directory, x)),
+                reverse=True
+            )
+        else:
+            sorted_files = sorted(files, key=lambda x: x.lower())
+        sorted_results[directory] = sorted_files
+    return sorted_results
+
+# Индекс имён файлов (SQLite). Для каждой директории хранится её mtime и список файлов;
+# при пересканировании директория перечитывается только если её mtime изменился.
+index_lock = threading.Lock()
+index_checked = {}  # путь -> время последней сверки с диском
+
+def open_index_db():
+    conn = sqlite3.connect(INDEX_DB_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS index_dirs (
+            path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS index_dirs_parent ON index_dirs(parent);
+        CREATE TABLE IF NOT EXISTS index_files (
+            dir TEXT, name TEXT, name_lower TEXT, mtime REAL, size INTEGER,
+            PRIMARY KEY (dir, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS hash_cache (
+            dev INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, partial TEXT, full TEXT,
+            PRIMARY KEY (dev, inode)
+        ) WITHOUT ROWID;
+    """)
+    conn.create_function("regexp", 2, sqlite_regexp, deterministic=True)
+    return conn
+
+@functools.lru_cache(maxsize=32)
+def compile_regex(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+def sqlite_regexp(pattern, value):
+    return compile_regex(pattern).match(value) is not None
+
+# Условие "путь равен prefix или лежит внутри него", использующее индекс по столбцу
+def path_prefix_clause(column, prefix):
+    sep = os.sep
+    return (
+        f"({column} = ? OR ({column} >= ? AND {column} < ?))",
+        (prefix, prefix.rstrip(sep) + sep, prefix.rstrip(sep) + chr(ord(sep) + 1)),
+    )
+
+def drop_index_subtree(conn, path):
+    for table, column in (("index_dirs", "path"), ("index_files", "dir")):
+        clause, params = path_prefix_clause(column, path)
+        conn.execute(f"DELETE FROM {table} WHERE {clause}", params)
+
+# Перечитывает одну директорию и возвращает список её поддиректорий
+def index_directory(conn, path, mtime_ns):
+    files = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            files.append((path, entry.name, entry.name.lower(), st.st_mtime, st.st_size))
+    known = {row[0] for row in conn.execute("SELECT path FROM index_dirs WHERE parent = ?", (path,))}
+    for gone in known.difference(subdirs):
+        drop_index_subtree(conn, gone)
+    conn.execute("DELETE FROM index_files WHERE dir = ?", (path,))
+    conn.executemany("INSERT OR REPLACE INTO index_files VALUES (?, ?, ?, ?, ?)", files)
+    conn.execute(
+        "INSERT OR REPLACE INTO index_dirs VALUES (?, ?, ?)",
+        (path, os.path.dirname(path), mtime_ns),
+    )
+    return subdirs
+
+# Инкрементальная сверка индекса с диском: stat для каждой директории,
+# полное чтение — только для изменившихся
+def refresh_index(conn, top):
+    stack = [top]
+    with conn:
+        while stack:
+            path = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                drop_index_subtree(conn, path)
+                continue
+            row = conn.execute("SELECT mtime_ns FROM index_dirs WHERE path = ?", (path,)).fetchone()
+            if row and row[0] == mtime_ns:
+                stack.extend(r[0] for r in conn.execute("SELECT path FROM index_dirs WHERE parent = ?", (path,)))
+                continue
+            try:
+                stack.extend(index_directory(conn, path, mtime_ns))
+            except OSError:
+                continue
+
+# Изменения, сделанные через бота, должны сразу попадать в результаты поиска и /ls
+def invalidate_index():
+    index_checked.clear()
+    content_index_checked.clear()
+    with listing_lock:
+        listing_cache.clear()
+
+def index_is_fresh(path):
+    now = time.time()
+    while True:
+        if now - index_checked.get(path, 0) < INDEX_RESCAN_INTERVAL:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+# Глубина считается в уровнях директорий ниже current_dir (0 — только сама current_dir)
+def within_depth(directory, current_dir, depth):
+    rel = os.path.relpath(directory, current_dir)
+    return rel == "." or rel.count(os.sep) + 1 <= depth
+
+# Поиск по индексу имён (выполняется в пуле потоков), результаты уже отсортированы
+def search_index(current_dir, matcher, depth, file_type, sort_by, reindex=False, limit=None, excludes=()):
+    with index_lock:
+        conn = open_index_db()
+        try:
+            if reindex:
+                with conn:
+                    drop_index_subtree(conn, current_dir)
+            if reindex or not index_is_fresh(current_dir):
+                refresh_index(conn, current_dir)
+                index_checked[current_dir] = time.time()
+        finally:
+            conn.close()
+    conn = open_index_db()
+    try:
+        clause, params = path_prefix_clause("dir", current_dir)
+        sql = f"SELECT dir, name FROM index_files WHERE {clause}"
+        params = list(params)
+        if file_type:
+            sql += " AND substr(name, -length(?)) = ?"
+            params += [f".{file_type}", f".{file_type}"]
+        sql += " AND name REGEXP ?"
+        params.append(matcher.pattern)
+        sql += " ORDER BY dir, mtime DESC" if sort_by == "date" else " ORDER BY dir, name_lower"
+        results = {}
+        found = 0
+        for directory, name in conn.execute(sql, params):
+            if not within_depth(directory, current_dir, depth):
+                continue
+            if excludes and path_excluded(os.path.join(directory, name), current_dir, excludes):
+                continue
+            results.setdefault(directory, []).append(name)
+            found += 1
+            if limit and found >= limit:
+                break
+        return results
+    finally:
+        conn.close()
+
+# Полнотекстовый индекс (SQLite FTS5 с триграммами) для content: поиска.
+# Индекс сужает список кандидатов, точное совпадение проверяется чтением файла.
+content_index_checked = {}  # корень -> время последней сверки с диском
+content_index_large = {}  # корень -> файлы больше CONTENT_INDEX_MAX_FILE_SIZE, их читают напрямую
+content_index_available = None
+
+def open_content_index_db():
+    global content_index_available
+    conn = open_index_db()
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS content_files (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS content_fts USING fts5(body, tokenize='trigram');
+        """)
+        content_index_available = True
+    except sqlite3.OperationalError as e:
+        logger.error("Полнотекстовый индекс недоступен: %s", e)
+        content_index_available = False
+        conn.close()
+        return None
+    return conn
+
+def content_index_root(path):
+    for root in CONTENT_INDEX_ROOTS:
+        if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+            return root
+    return None
+
+def index_file_content(conn, path, st):
+    row = conn.execute("SELECT rowid, mtime_ns, size FROM content_files WHERE path = ?", (path,)).fetchone()
+    if row and row[1] == st.st_mtime_ns and row[2] == st.st_size:
+        return
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return
+    if row:
+        conn.execute("DELETE FROM content_fts WHERE rowid = ?", (row[0],))
+        conn.execute("UPDATE content_files SET mtime_ns = ?, size = ? WHERE rowid = ?", (st.st_mtime_ns, st.st_size, row[0]))
+        rowid = row[0]
+    else:
+        rowid = conn.execute(
+            "INSERT INTO content_files (path, mtime_ns, size) VALUES (?, ?, ?)", (path, st.st_mtime_ns, st.st_size)
+        ).lastrowid
+    # Бинарные файлы запоминаем, но не индексируем
+    if b"\0" not in data[:8192]:
+        conn.execute("INSERT INTO content_fts (rowid, body) VALUES (?, ?)", (rowid, data.decode("utf-8", errors="replace")))
+
+# Сверка полнотекстового индекса с диском: перечитываются только файлы с изменившимися mtime/size.
+# Слишком большие файлы в индекс не попадают, их список запоминается для потокового поиска.
+def refresh_content_index(conn, root):
+    seen = set()
+    large = []
+    stack = [root]
+    with conn:
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            continue
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if st.st_size > CONTENT_INDEX_MAX_FILE_SIZE:
+                        large.append(entry.path)
+                        continue
+                    seen.add(entry.path)
+                    index_file_content(conn, entry.path, st)
+        clause, params = path_prefix_clause("path", root)
+        for rowid, path in conn.execute(f"SELECT rowid, path FROM content_files WHERE {clause}", params).fetchall():
+            if path not in seen:
+                conn.execute("DELETE FROM content_fts WHERE rowid = ?", (rowid,))
+                conn.execute("DELETE FROM content_files WHERE rowid = ?", (rowid,))
+    content_index_large[root] = large
+
+# Потоковый поиск подстроки в файле блоками по chunk_size байт.
+# Хвост предыдущего блока сохраняется, чтобы найти совпадения на стыке блоков.
+def file_contains_text(path, query, chunk_size=CONTENT_SCAN_CHUNK_SIZE):
+    needle = query.encode("utf-8")
+    overlap = len(needle) - 1
+    try:
+        with open(path, "rb") as f:
+            chunk = f.read(chunk_size)
+            # Бинарные файлы пропускаем
+            if b"\0" in chunk[:8192]:
+                return False
+            tail = b""
+            while chunk:
+                data = tail + chunk
+                if needle in data:
+                    return True
+                tail = data[-overlap:] if overlap else b""
+                chunk = f.read(chunk_size)
+    except OSError:
+        pass  # Пропускаем файлы, которые невозможно прочитать
+    return False
+
+# Задача для пула процессов: проверяет пачку файлов и возвращает совпавшие пути
+def scan_files_for_text(paths, query, chunk_size):
+    return [path for path in paths if file_contains_text(path, query, chunk_size)]
+
+# Кандидаты для поиска по содержимому из полнотекстового индекса (выполняется в пуле потоков).
+# Возвращает None, если индекс к этому запросу неприменим.
+def content_index_candidates(current_dir, query, depth, file_type, reindex=False, excludes=()):
+    root = content_index_root(current_dir)
+    # Триграммам нужно минимум три символа
+    if root is None or len(query) < 3 or content_index_available is False:
+        return None
+    with index_lock:
+        conn = open_content_index_db()
+        if conn is None:
+            return None
+        try:
+            if (reindex or root not in content_index_large
+                    or time.time() - content_index_checked.get(root, 0) >= INDEX_RESCAN_INTERVAL):
+                refresh_content_index(conn, root)
+                content_index_checked[root] = time.time()
+        finally:
+            conn.close()
+    conn = open_content_index_db()
+    if conn is None:
+        return None
+    try:
+        clause, params = path_prefix_clause("f.path", current_dir)
+        rows = conn.execute(
+            f"SELECT f.path FROM content_fts JOIN content_files f ON f.rowid = content_fts.rowid "
+            f"WHERE content_fts MATCH ? AND {clause} ORDER BY f.path",
+            ['"' + query.replace('"', '""') + '"', *params],
+        ).fetchall()
+    finally:
+        conn.close()
+    # Файлы, не попавшие в индекс по размеру, проверяются чтением наравне с найденными в индексе
+    prefix = current_dir.rstrip(os.sep) + os.sep
+    paths = sorted({path for (path,) in rows}.union(
+        path for path in content_index_large.get(root, ()) if path.startswith(prefix)
+    ))
+    candidates = []
+    for path in paths:
+        directory, file = os.path.split(path)
+        if file_type and not file.endswith(f".{file_type}"):
+            continue
+        if excludes and path_excluded(path, current_dir, excludes):
+            continue
+        if within_depth(directory, current_dir, depth):
+            candidates.append(path)
+    return candidates
+
+# Параллельная проверка кандидатов в пуле процессов. Совпадения отдаются пачками по мере
+# готовности; после limit найденных файлов оставшиеся задачи отменяются.
+async def iter_content_matches(paths, query, limit):
+    batches = [paths[i:i + CONTENT_SCAN_BATCH_SIZE] for i in range(0, len(paths), CONTENT_SCAN_BATCH_SIZE)]
+    pending = set()
+    next_batch = 0
+    found = 0
+    try:
+        while next_batch < len(batches) or pending:
+            while next_batch < len(batches) and len(pending) < CPU_PROCESSES * 2:
+                # Через run_in_process: пачки идут под лимитом команды search и учитываются в io_wait
+                pending.add(asyncio.ensure_future(run_in_process(
+                    "search", scan_files_for_text, batches[next_batch], query, CONTENT_SCAN_CHUNK_SIZE
+                )))
+                next_batch += 1
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                matches = future.result()[:limit - found]
+                found += len(matches)
+                if matches:
+                    yield matches
+                if found >= limit:
+                    return
+    finally:
+        for future in pending:
+            future.cancel()
+
+# Формирование сообщений с результатами поиска, сгруппированными по директориям
+def format_search_results(sorted_results):
+    output_blocks = []
+    for directory, files in sorted_results.items():
+        # Здесь можно экранировать только имя директории, если это необходимо
+        block = f"```\nДиректория: {directory}\n"
+        block += "\n".join([
+            f"{EMOJI_MAP.get(os.path.splitext(f)[1].lower(), '📄')} {escape_markdown_v2(f)}"
+            for f in files
+        ])
+        block += "\n```"
+        output_blocks.append(block)
+    final_text = "\n".join(output_blocks)
+
+    # Разбиение текста на части (без повторного экранирования)
+    MAX_MESSAGE_LENGTH = 4096
+    messages = []
+    buffer = ""
+    for line in final_text.split("\n"):
+        # Не применяем escape_markdown_v2 к строке, чтобы сохранить маркдаун-разметку
+        if len(buffer) + len(line) + 5 > MAX_MESSAGE_LENGTH:
+            # Если блок открыт, закрываем его и открываем заново в следующем сообщении
+            if buffer.count("```") % 2:
+                messages.append(buffer + "```")
+                buffer = "```\n"
+            else:
                 messages.append(buffer)
                 buffer = ""
-            buffer += escaped_line + "\n"
-        if buffer:
-            if buffer.startswith("```") and not buffer.endswith("```"):
-                buffer += "\n```"  # Закрываем блок, если он открыт
-            messages.append(buffer)
-        # Отправка всех частей
-        for i, message in enumerate(messages):
-            if i == 0:
-                text = f"{file_name}\n```\n{message}\n```"
-            else:
-                text = f"```\n{message}\n```"
-            await update.message.reply_text(text, parse_mode="Markdown")
-        log_action(user_id, "view", {"file": full_path})
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка просмотра файла: {e}")
-        log_action(user_id, "view", {"error": str(e), "file": full_path})
+        buffer += line + "\n"
+    if buffer:
+        if buffer.count("```") % 2:
+            buffer += "```"
+        messages.append(buffer)
+    return messages
 
-def escape_markdown_v2(text):
-    """
-    Экранирует все зарезервированные символы для MarkdownV2.
-    """
-    reserved_chars = r"_*[]()~`>#+-=|{}.!"
-    return re.sub(f"([{re.escape(reserved_chars)}])", r"\\\1", text)
+# Те же результаты простым текстом (для отправки файлом)
+def format_search_plain(sorted_results):
+    return "\n".join(
+        f"{directory}\n" + "\n".join(f"  {f}" for f in files) for directory, files in sorted_results.items()
+    )
+
+def group_paths_by_directory(paths):
+    results = {}
+    for path in paths:
+        directory, file = os.path.split(path)
+        results.setdefault(directory, []).append(file)
+    return results
 
 @authorized_only
+@background_job("search")
 async def search(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     query = ' '.join(context.args)
@@ -273,6 +2467,15 @@ async def search(update: Update, context: CallbackContext) -> None:
         regex_mode = False
         content_search = False
         sort_by = "name"  # По умолчанию сортировка по имени
+        limit = SEARCH_RESULT_LIMIT
+        excludes = ()
+        max_files = None
+        reindex = "--reindex" in query
+        if reindex:
+            query = query.replace("--reindex", "").strip()
+        follow_symlinks = "--follow-links" in query
+        if follow_symlinks:
+            query = query.replace("--follow-links", "").strip()
         if "--depth=" in query:
             depth_str = query.split("--depth=")[1].split()[0]
             depth = int(depth_str)
@@ -283,128 +2486,372 @@ async def search(update: Update, context: CallbackContext) -> None:
         if "--sort=" in query:
             sort_by = query.split("--sort=")[1].split()[0]
             query = query.replace(f"--sort={sort_by}", "").strip()
+        if "--limit=" in query:
+            limit_str = query.split("--limit=")[1].split()[0]
+            limit = max(1, int(limit_str))
+            query = query.replace(f"--limit={limit_str}", "").strip()
+        if "--exclude=" in query:
+            exclude_str = query.split("--exclude=")[1].split()[0]
+            excludes = tuple(filter(None, exclude_str.split(",")))
+            query = query.replace(f"--exclude={exclude_str}", "").strip()
+        if "--max-files=" in query:
+            max_files_str = query.split("--max-files=")[1].split()[0]
+            max_files = max(1, int(max_files_str))
+            query = query.replace(f"--max-files={max_files_str}", "").strip()
         if query.startswith("regex:"):
             regex_mode = True
             query = query[6:]  # Убираем префикс "regex:"
         if query.startswith("content:"):
             content_search = True
             query = query[8:]  # Убираем префикс "content:"
-        # Рекурсивный обход всех файлов и папок
-        current_depth = 0
-        for root, dirs, files in os.walk(current_dir):
-            if current_depth > depth:
-                break
-            for file in files:
-                full_path = os.path.join(root, file)
-                # Пропускаем файлы, не соответствующие типу
-                if file_type and not file.endswith(f".{file_type}"):
-                    continue
-                # Проверка на соответствие маске
-                if not regex_mode and fnmatch.fnmatch(file.lower(), query.lower()):
-                    results.setdefault(root, []).append(file)
-                    continue
-                # Проверка на вхождение текста в имя файла
-                if not regex_mode and query.lower() in file.lower():
-                    results.setdefault(root, []).append(file)
-                    continue
-                # Проверка на соответствие регулярному выражению
-                if regex_mode:
-                    pattern = re.compile(query, re.IGNORECASE)
-                    if pattern.match(file):
-                        results.setdefault(root, []).append(file)
-                        continue
-                # Поиск по содержимому файла
-                if content_search:
-                    try:
-                        with open(full_path, "r", encoding="utf-8") as f:
-                            if query in f.read():
-                                results.setdefault(root, []).append(file)
-                    except Exception:
-                        continue  # Пропускаем файлы, которые невозможно прочитать
-            current_depth += 1
-        # Если результаты найдены
-        if results:
-            # Сортировка результатов
-            sorted_results = {}
-            for directory, files in results.items():
-                if sort_by == "date":
-                    sorted_files = sorted(
-                        files,
-                        key=lambda x: os.path.getmtime(os.path.join(directory, x)),
-                        reverse=True
-                    )
-                else:
-                    sorted_files = sorted(files, key=lambda x: x.lower())
-                sorted_results[directory] = sorted_files
-        # Формирование вывода
-        output_blocks = []
-        for directory, files in sorted_results.items():
-            # Здесь можно экранировать только имя директории, если это необходимо
-            block = f"```\nДиректория: {directory}\n"
-            block += "\n".join([
-                f"{EMOJI_MAP.get(os.path.splitext(f)[1].lower(), '📄')} {escape_markdown_v2(f)}"
-                for f in files
-            ])
-            block += "\n```"
-            output_blocks.append(block)
-        final_text = "\n".join(output_blocks)
-
-        # Разбиение текста на части (без повторного экранирования)
-        MAX_MESSAGE_LENGTH = 4096
-        messages = []
-        buffer = ""
-        for line in final_text.split("\n"):
-            # Не применяем escape_markdown_v2 к строке, чтобы сохранить маркдаун-разметку
-            if len(buffer) + len(line) + 1 > MAX_MESSAGE_LENGTH:
-                # Если блок открыт, закрываем его
-                if buffer.startswith("```") and not buffer.endswith("```"):
-                    buffer += "\n```"
-                messages.append(buffer)
-                buffer = ""
-            buffer += line + "\n"
-        if buffer:
-            if buffer.startswith("```") and not buffer.endswith("```"):
-                buffer += "\n```"
-            messages.append(buffer)
-
-        # Отправка всех частей
-        for message in messages:
-            await update.message.reply_text(message, parse_mode="Markdown")
+        if content_search:
+            await search_content(
+                update, user_id, current_dir, query, depth, file_type, regex_mode, sort_by, reindex, limit,
+                excludes, max_files, follow_symlinks,
+            )
+            return
+        patterns = [query] if regex_mode else split_search_patterns(query)
+        matcher = compile_search_query(patterns, regex_mode)
+        if max_files or follow_symlinks:
+            # Бюджет файлов и переход по ссылкам относятся к обходу диска, индекс здесь не подходит
+            results, _ = await run_blocking(
+                "search", find_files, current_dir, matcher, depth, file_type, False,
+                excludes, max_files, follow_symlinks, limit + 1,
+            )
+            results = await run_blocking("search", sort_search_results, results, sort_by)
         else:
+            # Поиск по имени отвечает из индекса
+            results = await run_blocking(
+                "search", search_index, current_dir, matcher, depth, file_type, sort_by, reindex, limit + 1, excludes
+            )
+        # Запрашивается на один результат больше: так видно, что совпадений больше лимита
+        results, truncated = truncate_search_results(results, limit)
+        if not results:
             await update.message.reply_text("Файлы не найдены.")
+            log_action(user_id, "search", {"query": query, "results": results})
+            return
+        # Отправка всех частей (большой вывод — одним файлом)
+        outbox = Outbox(update, "search.txt", parse_mode="Markdown")
+        outbox.add(format_search_results(results), format_search_plain(results))
+        await outbox.close()
+        if truncated:
+            await update.message.reply_text(f"Показаны первые {limit} результатов (--limit={limit}).")
         log_action(user_id, "search", {"query": query, "results": results})
     except Exception as e:
         await update.message.reply_text(f"Ошибка поиска: {e}")
         log_action(user_id, "search", {"error": str(e), "query": query})
 
-# Вспомогательная функция для смены директории
-async def change_directory(update: Update, context: CallbackContext, path: str) -> None:
+# Первые limit результатов (порядок директорий и файлов сохраняется) и признак, что их было больше
+def truncate_search_results(results, limit):
+    truncated = {}
+    left = limit
+    for directory, files in results.items():
+        if left <= 0:
+            return truncated, True
+        if len(files) > left:
+            truncated[directory] = files[:left]
+            return truncated, True
+        truncated[directory] = files
+        left -= len(files)
+    return truncated, False
+
+# Поиск по содержимому: совпадения по имени отправляются сразу, совпадения по содержимому —
+# по мере сканирования, пачками раз в SEARCH_FLUSH_INTERVAL секунд
+async def search_content(update, user_id, current_dir, query, depth, file_type, regex_mode, sort_by, reindex, limit,
+                         excludes=(), max_files=None, follow_symlinks=False):
+    # Имя файла проверяется по тому же тексту, что и содержимое
+    matcher = compile_search_query([query], regex_mode)
+    candidates = None
+    if not regex_mode and not max_files and not follow_symlinks:
+        candidates = await run_blocking(
+            "search", content_index_candidates, current_dir, query, depth, file_type, reindex, excludes
+        )
+    if candidates is not None:
+        # Совпадения по имени файла, как и при обходе диска
+        results = await run_blocking(
+            "search", search_index, current_dir, matcher, depth, file_type, sort_by, reindex, limit + 1, excludes
+        )
+        named = {os.path.join(d, f) for d, files in results.items() for f in files}
+        candidates = [path for path in candidates if path not in named]
+    else:
+        # Индекс неприменим: рекурсивный обход всех файлов и папок
+        results, candidates = await run_blocking(
+            "search", find_files, current_dir, matcher, depth, file_type, True,
+            excludes, max_files, follow_symlinks,
+        )
+    results, truncated = truncate_search_results(results, limit)
+    found = sum(len(files) for files in results.values())
+
+    outbox = Outbox(update, "search.txt", parse_mode="Markdown")
+
+    async def flush(batch):
+        sorted_batch = await run_blocking("search", sort_search_results, batch, sort_by)
+        outbox.add(format_search_results(sorted_batch), format_search_plain(sorted_batch))
+        await outbox.flush()
+
+    if results:
+        await flush(results)
+    matches_found = []
+    flushed = 0
+    last_flush = time.monotonic()
+    if not truncated and found < limit:
+        # Как и для имён, ищется на одно совпадение больше лимита; лишнее не показывается
+        async for matches in iter_content_matches(candidates, query, limit - found + 1):
+            matches_found.extend(matches)
+            if len(matches_found) > limit - found:
+                del matches_found[limit - found:]
+                truncated = True
+            if time.monotonic() - last_flush >= SEARCH_FLUSH_INTERVAL:
+                await flush(group_paths_by_directory(matches_found[flushed:]))
+                flushed = len(matches_found)
+                last_flush = time.monotonic()
+    if flushed < len(matches_found):
+        await flush(group_paths_by_directory(matches_found[flushed:]))
+    await outbox.close()
+    for path in matches_found:
+        directory, file = os.path.split(path)
+        results.setdefault(directory, []).append(file)
+    found += len(matches_found)
+    if not found:
+        await update.message.reply_text("Файлы не найдены.")
+    elif truncated:
+        await update.message.reply_text(f"Показаны первые {limit} результатов (--limit={limit}).")
+    log_action(user_id, "search", {"query": query, "results": results})
+
+# Поиск дубликатов (/dupes). Файлы сравниваются поэтапно: размер, хэш первого и последнего
+# блоков, полный хэш; на каждом этапе отсеиваются группы из одного файла. Хэши кэшируются
+# в базе индекса по (устройство, inode) и действительны, пока не изменились размер и mtime.
+
+# Сбор файлов обходом как у /search (выполняется в пуле потоков).
+# Жёсткие ссылки на один inode — один файл, место они не занимают повторно.
+# Учитываются только обычные файлы: удаление символической ссылки место не освобождает.
+def collect_dupe_candidates(top, depth, excludes, min_size):
+    by_size = {}
+    seen = set()
+    for directory, files in walk_tree(top, depth, excludes):
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if st.st_size < min_size or not st.st_size or (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            by_size.setdefault(st.st_size, []).append((path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+    return [group for group in by_size.values() if len(group) > 1]
+
+# Хэширование пачки файлов (выполняется в пуле процессов). mode — "partial" или "full".
+# Файл, который успел стать ссылкой или не обычным файлом, получает None и выпадает из групп.
+def hash_files(paths, mode, block_size, chunk_size):
+    results = []
+    for path in paths:
+        digest = hashlib.blake2b(digest_size=20)
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+            with open(fd, "rb") as f:
+                if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                    results.append(None)
+                    continue
+                if mode == "partial":
+                    digest.update(f.read(block_size))
+                    size = os.fstat(f.fileno()).st_size
+                    if size > block_size:
+                        f.seek(max(block_size, size - block_size))
+                        digest.update(f.read(block_size))
+                else:
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+            results.append(digest.hexdigest())
+        except OSError:
+            results.append(None)
+    return results
+
+def load_hash_cache(files):
+    cached = {}
+    with index_lock:
+        conn = open_index_db()
+        try:
+            for path, dev, inode, size, mtime_ns in files:
+                row = conn.execute(
+                    "SELECT partial, full FROM hash_cache WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                    (dev, inode, size, mtime_ns),
+                ).fetchone()
+                if row:
+                    cached[path] = {"partial": row[0], "full": row[1]}
+        finally:
+            conn.close()
+    return cached
+
+def save_hash_cache(rows):
+    with index_lock:
+        conn = open_index_db()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO hash_cache (dev, inode, size, mtime_ns, partial, full) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+        finally:
+            conn.close()
+
+# Хэши для файлов без записи в кэше считаются пачками параллельно в пуле процессов
+async def compute_hashes(files, mode, cache):
+    missing = [f for f in files if not (cache.get(f[0]) or {}).get(mode)]
+    batches = [missing[i:i + DUPES_HASH_BATCH_SIZE] for i in range(0, len(missing), DUPES_HASH_BATCH_SIZE)]
+    results = await asyncio.gather(*(
+        run_in_process("dupes", hash_files, [f[0] for f in batch], mode, DUPES_PARTIAL_BLOCK, CONTENT_SCAN_CHUNK_SIZE)
+        for batch in batches
+    ))
+    for batch, digests in zip(batches, results):
+        for f, digest in zip(batch, digests):
+            cache.setdefault(f[0], {"partial": None, "full": None})[mode] = digest
+            report_job_progress(f[3] if mode == "full" else 0, 1)
+    return len(missing)
+
+# Разбиение групп по значению хэша; группы из одного файла отбрасываются
+def regroup(groups, cache, mode):
+    result = []
+    for group in groups:
+        by_hash = {}
+        for f in group:
+            digest = (cache.get(f[0]) or {}).get(mode)
+            if digest:
+                by_hash.setdefault(digest, []).append(f)
+        result.extend(g for g in by_hash.values() if len(g) > 1)
+    return result
+
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+# Группы дубликатов в формате /search: блок на группу, сначала самые «дорогие»
+def format_dupe_groups(groups):
+    output_blocks = []
+    plain_blocks = []
+    for group in groups:
+        size = group[0][3]
+        header = f"{len(group)} × {human_size(size)}, освободится {human_size(size * (len(group) - 1))}"
+        lines = [f"{EMOJI_MAP.get(os.path.splitext(f[0])[1].lower(), '📄')} {f[0]}" for f in group]
+        output_blocks.append("```\n" + header + "\n" + "\n".join(lines).replace("`", "'") + "\n```")
+        plain_blocks.append(header + "\n" + "\n".join(f"  {f[0]}" for f in group))
+    messages = []
+    for block in output_blocks:
+        # Очень большая группа обрезается, чтобы поместиться в сообщение
+        messages.append(block if len(block) <= 4096 else block[:4000] + "\n…\n```")
+    return messages, "\n\n".join(plain_blocks)
+
+# Команда /dupes [путь] [--min-size=N] [--depth=N] [--exclude=a,b]
+@authorized_only
+@background_job("dupes")
+async def dupes(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
+    usage = "Использование: /dupes [путь] [--min-size=1M] [--depth=N] [--exclude=маска1,маска2]"
+    min_size = 1
+    depth = 1000
+    excludes = ()
+    args = []
+    try:
+        for arg in context.args:
+            if arg.startswith("--min-size="):
+                min_size = max(1, parse_size(arg.split("=", 1)[1]))
+            elif arg.startswith("--depth="):
+                depth = int(arg.split("=", 1)[1])
+            elif arg.startswith("--exclude="):
+                excludes = tuple(filter(None, arg.split("=", 1)[1].split(",")))
+            else:
+                args.append(arg)
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
     current_dir = get_current_dir(user_id)
-    if not path:
-        await update.message.reply_text('Укажите путь после команды cd или установите дефолтный путь через /settings')
+    target = os.path.normpath(os.path.join(current_dir, " ".join(args))) if args else current_dir
+    if not await run_blocking("dupes", os.path.isdir, target):
+        await update.message.reply_text("Указанная директория не существует.")
+        return
+    started = time.monotonic()
+    try:
+        groups = await run_blocking("dupes", collect_dupe_candidates, target, depth, excludes, min_size)
+        candidates = [f for group in groups for f in group]
+        cache = await run_blocking("dupes", load_hash_cache, candidates)
+        hashed = 0
+        # Маленькие файлы целиком помещаются в частичный хэш, для них он же и полный
+        hashed += await compute_hashes(candidates, "partial", cache)
+        for f in candidates:
+            if f[3] <= 2 * DUPES_PARTIAL_BLOCK and cache.get(f[0], {}).get("partial"):
+                cache[f[0]]["full"] = cache[f[0]]["partial"]
+        groups = regroup(groups, cache, "partial")
+        hashed += await compute_hashes([f for group in groups for f in group], "full", cache)
+        groups = regroup(groups, cache, "full")
+        await run_blocking("dupes", save_hash_cache, [
+            (dev, inode, size, mtime_ns, cache[path]["partial"], cache[path]["full"])
+            for path, dev, inode, size, mtime_ns in candidates
+            if cache.get(path, {}).get("partial")
+        ])
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка поиска дубликатов: {e}")
+        log_action(user_id, "dupes", {"error": str(e), "path": target})
+        return
+    if not groups:
+        await update.message.reply_text("Дубликаты не найдены.")
+        log_action(user_id, "dupes", {"path": target, "groups": 0})
         return
+    groups.sort(key=lambda g: g[0][3] * (len(g) - 1), reverse=True)
+    reclaimable = sum(g[0][3] * (len(g) - 1) for g in groups)
+    await update.message.reply_text(
+        f"Групп дубликатов: {len(groups)}, файлов: {sum(len(g) for g in groups)}, "
+        f"можно освободить: {human_size(reclaimable)}\n"
+        f"Проверено файлов: {len(candidates)}, хэшировано заново: {hashed} ({time.monotonic() - started:.1f} с)"
+    )
+    messages, plain = format_dupe_groups(groups)
+    outbox = Outbox(update, "dupes.txt", parse_mode="Markdown")
+    outbox.add(messages, plain)
+    await outbox.close()
+    log_action(user_id, "dupes", {
+        "path": target, "groups": len(groups), "reclaimable": reclaimable, "files": [f[0] for g in groups for f in g],
+    })
+
+# Поиск директории для cd (выполняется в пуле потоков), None если не найдена
+def resolve_directory(current_dir, path):
     new_path = os.path.normpath(os.path.join(current_dir, path))
     if os.path.isdir(new_path):
-        current_dirs[str(user_id)] = new_path
-        await update.message.reply_text(f'Текущая директория изменена на: {new_path}')
-        log_action(user_id, "cd", {"from": current_dir, "to": new_path})
-        return
+        return new_path
     # Если путь не содержит разделителей, пробуем найти папку по имени (без учёта регистра)
     if ('/' not in path) and ('\\' not in path):
         for folder in os.listdir(current_dir):
             full_folder_path = os.path.join(current_dir, folder)
             if os.path.isdir(full_folder_path) and folder.lower() == path.lower():
-                current_dirs[str(user_id)] = full_folder_path
-                await update.message.reply_text(f'Текущая директория изменена на: {full_folder_path}')
-                log_action(user_id, "cd", {"from": current_dir, "to": full_folder_path})
-                return
+                return full_folder_path
+    return None
+
+# Вспомогательная функция для смены директории
+async def change_directory(update: Update, context: CallbackContext, path: str) -> None:
+    user_id = update.effective_user.id
+    current_dir = get_current_dir(user_id)
+    if not path:
+        await update.message.reply_text('Укажите путь после команды cd или установите дефолтный путь через /settings')
+        return
+    new_path = await run_blocking("cd", resolve_directory, current_dir, path)
+    if new_path:
+        set_current_dir(user_id, new_path)
+        await update.message.reply_text(f'Текущая директория изменена на: {new_path}')
+        log_action(user_id, "cd", {"from": current_dir, "to": new_path})
+        return
     await update.message.reply_text('Указанная директория не существует.')
 
 # Команды управления файлами
 
 # Команда /mv
 @authorized_only
+@background_job("mv")
 async def mv(update: Update, context: CallbackContext) -> None:
     """Перемещает (переименовывает) файл или папку. Использование: /mv <источник> <назначение>"""
     user_id = update.effective_user.id
@@ -417,13 +2864,15 @@ async def mv(update: Update, context: CallbackContext) -> None:
     src_path = os.path.normpath(os.path.join(current_dir, src))
     dst_path = os.path.normpath(os.path.join(current_dir, dst))
     try:
-        shutil.move(src_path, dst_path)  # Использование shutil.move
+        await run_blocking("mv", shutil.move, src_path, dst_path, copy_function=cancellable_copy2)
+        invalidate_index()
         await update.message.reply_text(f"Перемещено: {src} -> {dst}")
         log_action(user_id, "mv", {"src": src_path, "dst": dst_path})
     except Exception as e:
         await update.message.reply_text(f"Ошибка перемещения: {e}")
 
 @authorized_only
+@background_job("cp")
 async def cp(update: Update, context: CallbackContext) -> None:
     """Копирует файл или папку. Использование: /cp <источник> <назначение>"""
     user_id = update.effective_user.id
@@ -436,19 +2885,64 @@ async def cp(update: Update, context: CallbackContext) -> None:
     src_path = os.path.normpath(os.path.join(current_dir, src))
     dst_path = os.path.normpath(os.path.join(current_dir, dst))
     try:
-        if os.path.isfile(src_path):
-            shutil.copy2(src_path, dst_path)
-        elif os.path.isdir(src_path):
-            shutil.copytree(src_path, dst_path)
-        else:
+        plan = await run_blocking("cp", plan_copy, src_path, dst_path)
+        if plan is None:
             await update.message.reply_text("Источник не найден")
             return
-        await update.message.reply_text(f"Скопировано: {src} -> {dst}")
-        log_action(user_id, "cp", {"src": src_path, "dst": dst_path})
-    except Exception as e:
+        workers = await run_blocking("cp", copy_worker_count, src_path, dst_path)
+    except (OSError, ValueError) as e:
         await update.message.reply_text(f"Ошибка копирования: {e}")
+        return
+    progress = new_copy_progress(plan)
+    title = f"Копирование: {src} -> {dst}"
+    task = asyncio.ensure_future(run_copy(plan, progress, workers))
+    # Быстрое копирование завершается одним ответом; долгое показывает прогресс в одном сообщении
+    message = None
+    while not task.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(task), COPY_PROGRESS_INTERVAL)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        except asyncio.TimeoutError:
+            text = format_copy_progress(title, progress)
+            try:
+                if message is None:
+                    message = await update.message.reply_text(text)
+                else:
+                    await message.edit_text(text)
+            except TelegramError as e:
+                logger.warning("Ошибка обновления прогресса копирования: %s", e)
+        except Exception:
+            break
+    invalidate_index()
+    try:
+        task.result()
+        copied = progress["bytes"] - progress["skipped_bytes"]
+        text = f"Скопировано: {src} -> {dst}\nФайлов: {progress['files']}, {human_size(copied)}"
+        if progress["skipped"]:
+            text += f", пропущено уже скопированных: {progress['skipped']}"
+        if progress["errors"]:
+            text += f"\nОшибок: {len(progress['errors'])}\n" + "\n".join(progress["errors"][:5])
+        log_action(user_id, "cp", {
+            "src": src_path, "dst": dst_path, "files": progress["files"], "skipped": progress["skipped"],
+            "bytes": progress["bytes"], "errors": progress["errors"],
+        })
+    except JobCancelled:
+        raise
+    except Exception as e:
+        text = f"Ошибка копирования: {e}"
+        log_action(user_id, "cp", {"error": str(e), "src": src_path, "dst": dst_path})
+    if message is None:
+        await update.message.reply_text(text)
+    else:
+        try:
+            await message.edit_text(text)
+        except TelegramError:
+            await update.message.reply_text(text)
 
 @authorized_only
+@background_job("rm")
 async def rm(update: Update, context: CallbackContext) -> None:
     """Удаляет файл или папку. Использование: /rm <путь>"""
     user_id = update.effective_user.id
@@ -459,13 +2953,10 @@ async def rm(update: Update, context: CallbackContext) -> None:
     current_dir = get_current_dir(user_id)
     target_path = os.path.normpath(os.path.join(current_dir, target))
     try:
-        if os.path.isfile(target_path):
-            os.remove(target_path)
-        elif os.path.isdir(target_path):
-            shutil.rmtree(target_path)
-        else:
+        if not await run_blocking("rm", remove_path, target_path):
             await update.message.reply_text("Файл или папка не найдены")
             return
+        invalidate_index()
         await update.message.reply_text(f"Удалено: {target}")
         log_action(user_id, "rm", {"target": target_path})
     except Exception as e:
@@ -482,7 +2973,8 @@ async def mkdir(update: Update, context: CallbackContext) -> None:
     current_dir = get_current_dir(user_id)
     folder_path = os.path.normpath(os.path.join(current_dir, folder_name))
     try:
-        os.makedirs(folder_path, exist_ok=False)
+        await run_blocking("mkdir", os.makedirs, folder_path, exist_ok=False)
+        invalidate_index()
         await update.message.reply_text(f"Папка создана: {folder_name}")
         log_action(user_id, "mkdir", {"folder": folder_path})
     except Exception as e:
@@ -499,18 +2991,169 @@ async def rmdir(update: Update, context: CallbackContext) -> None:
     current_dir = get_current_dir(user_id)
     folder_path = os.path.normpath(os.path.join(current_dir, folder_name))
     try:
-        os.rmdir(folder_path)
+        await run_blocking("rmdir", os.rmdir, folder_path)
+        invalidate_index()
         await update.message.reply_text(f"Папка удалена: {folder_name}")
         log_action(user_id, "rmdir", {"folder": folder_path})
     except Exception as e:
         await update.message.reply_text(f"Ошибка удаления папки: {e}")
 
+# Разбор --since: дата/время в ISO-формате или относительный срок (30m, 2h, 7d)
+def parse_since(value):
+    match = re.fullmatch(r"(\d+)([smhdw])", value)
+    if match:
+        seconds = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[match.group(2)]
+        return time.time() - int(match.group(1)) * seconds
+    return datetime.fromisoformat(value).timestamp()
+
+# Выборка из базы аудита (выполняется в пуле потоков), новые записи первыми
+def query_audit(user=None, cmd=None, since=None, limit=20):
+    conn = open_audit_db(AUDIT_DB_FILE)
+    try:
+        sql = "SELECT entry FROM actions"
+        conditions = []
+        params = []
+        if user is not None:
+            conditions.append("user_id = ?")
+            params.append(user)
+        if cmd:
+            conditions.append("command = ?")
+            params.append(cmd)
+        if since is not None:
+            conditions.append("ts >= ?")
+            params.append(since)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY ts DESC LIMIT ?"
+        params.append(limit)
+        return [json.loads(row[0]) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+# Команда /audit
+@authorized_only
+async def audit(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    if not AUDIT_DB_FILE:
+        await update.message.reply_text("База аудита отключена (AUDIT_DB_FILE).")
+        return
+    options = {"user": None, "cmd": None, "since": None, "limit": 20}
+    try:
+        for arg in context.args:
+            name, _, value = arg.partition("=")
+            if name == "--user":
+                options["user"] = int(value)
+            elif name == "--cmd":
+                options["cmd"] = value.lstrip("/")
+            elif name == "--since":
+                options["since"] = parse_since(value)
+            elif name == "--limit":
+                options["limit"] = max(1, min(200, int(value)))
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await update.message.reply_text("Использование: /audit [--user=ID] [--cmd=команда] [--since=2h|2024-01-31] [--limit=N]")
+        return
+    try:
+        entries = await run_blocking("audit", query_audit, **options)
+    except sqlite3.Error as e:
+        await update.message.reply_text(f"Ошибка чтения базы аудита: {e}")
+        return
+    if not entries:
+        await update.message.reply_text("Записей не найдено.")
+        return
+    lines = []
+    for entry in entries:
+        details = json.dumps(entry.get("details"), ensure_ascii=False)
+        if len(details) > 150:
+            details = details[:150] + "…"
+        line = f"{entry.get('timestamp', '')[:19]} {entry.get('user_id')} {entry.get('command')} {details}"
+        if sum(len(l) + 1 for l in lines) + len(line) > 3900:
+            break
+        lines.append(line)
+    await update.message.reply_text("```\n" + "\n".join(lines) + "\n```", parse_mode="Markdown")
+    log_action(user_id, "audit", {k: v for k, v in options.items() if v is not None})
+
+# Команда /jobs
+@authorized_only
+async def jobs_command(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    user_jobs = [job for job in jobs.values() if job["user_id"] == user_id]
+    if not user_jobs:
+        await update.message.reply_text("Задач нет.")
+        return
+    now = time.monotonic()
+    lines = []
+    for job in reversed(user_jobs):
+        line = f"#{job['id']} {job['title']} — {JOB_STATUS_NAMES[job['status']]}"
+        if job["started"] is not None:
+            elapsed = (job["finished"] or now) - job["started"]
+            line += f", {format_duration(elapsed)}"
+            if job["bytes"]:
+                line += f", {human_size(job['bytes'])} ({human_size(job['bytes'] / max(elapsed, 0.001))}/с)"
+            if job["files"]:
+                line += f", файлов: {job['files']}"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines))
+    log_action(user_id, "jobs", {"count": len(user_jobs)})
+
+# Команда /cancel <id>
+@authorized_only
+async def cancel_job(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    if not context.args or not context.args[0].lstrip("#").isdigit():
+        await update.message.reply_text("Использование: /cancel <номер задачи из /jobs>")
+        return
+    job = jobs.get(int(context.args[0].lstrip("#")))
+    if job is None or job["user_id"] != user_id:
+        await update.message.reply_text("Задача не найдена.")
+        return
+    if job["status"] not in ("queued", "running"):
+        await update.message.reply_text(f"Задача #{job['id']} уже {JOB_STATUS_NAMES[job['status']]}.")
+        return
+    job["cancel"].set()
+    job["task"].cancel()
+    await update.message.reply_text(f"Отменяю задачу #{job['id']}…")
+    log_action(user_id, "cancel", {"job": job["id"], "title": job["title"]})
+
+# Команда /stats [reset]
+@authorized_only
+async def stats_command(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    if context.args and context.args[0].lower() == "reset":
+        with stats_lock:
+            command_stats.clear()
+        await update.message.reply_text("Статистика сброшена.")
+        log_action(user_id, "stats", {"action": "reset"})
+        return
+    with stats_lock:
+        snapshot = {name: dict(entry, recent=list(entry["recent"])) for name, entry in command_stats.items()}
+    if not snapshot:
+        await update.message.reply_text("Статистики пока нет.")
+        return
+    lines = [f"{'команда':<12}{'n':>6}{'p50':>8}{'p95':>8}{'max':>8}{'I/O':>7}{'чтение':>10}{'запись':>10}{'сообщ':>7}"]
+    for name, entry in sorted(snapshot.items(), key=lambda item: item[1]["sum"], reverse=True):
+        recent = entry["recent"]
+        count = entry["count"]
+        io_share = entry["io_wait"] * 100 / entry["sum"] if entry["sum"] else 0
+        lines.append(
+            f"{name[:12]:<12}{count:>6}{percentile(recent, 50) * 1000:>7.0f}м{percentile(recent, 95) * 1000:>7.0f}м"
+            f"{max(recent) * 1000:>7.0f}м{io_share:>6.0f}%{human_size(entry['read_bytes'] / count):>10}"
+            f"{human_size(entry['write_bytes'] / count):>10}{entry['messages'] / count:>7.1f}"
+        )
+    text = (
+        f"Время в мс по последним {STATS_WINDOW} вызовам; I/O — доля ожидания пулов; "
+        "чтение, запись и сообщения — в среднем на вызов\n```\n" + "\n".join(lines) + "\n```"
+    )
+    await update.message.reply_text(text, parse_mode="Markdown")
+    log_action(user_id, "stats", {"commands": len(snapshot)})
+
 # Прочие команды
 
 @authorized_only
 async def start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    current_dirs[str(user_id)] = os.getcwd()  # Начинаем с текущей директории сервера
+    set_current_dir(user_id, os.getcwd())  # Начинаем с текущей директории сервера
     await update.message.reply_text('Привет! Используй /help чтобы увидеть доступные команды.')
     log_action(user_id, "start", {"cwd": os.getcwd()})
 
@@ -521,20 +3164,33 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "/start - Начать\n"
         "/help - Помощь\n"
         "/pwd - Показать текущую директорию\n"
-        "/ls - Показать содержимое директории\n"
+        "/ls [--page=N] - Показать содержимое директории (постранично)\n"
+        "/du [путь] [--top=N] [--depth=N] [--rescan] - Что занимает место\n"
+        "/dupes [путь] [--min-size=1M] [--depth=N] [--exclude=маски] - Поиск дубликатов\n"
         "/cd <путь> - Сменить директорию (без аргументов – дефолтный путь из настроек)\n"
         "/back - Вернуться на уровень выше\n"
-        "/download <имя_файла> - Скачать файл\n"
-        "/search --depth=(глубина поиска) --type=(расширение файла) --sort=(date) regex: (регулярные выражения) content: (поиск по содержимому) <текст или маска>\n\n"
-        "/view <имя файла> - Посмотреть содержимое файла\n"
+        "/history - Недавние директории (cd - — предыдущая, cd -N — из списка)\n"
+        "/download <имена файлов/папок> --compress=(auto/store/deflate) - Скачать ZIP-архивом\n"
+        "/download --resume - Дослать части, которые не удалось отправить\n"
+        "/search --depth=(глубина поиска) --type=(расширение файла) --sort=(date) --reindex (перестроить индекс) --limit=(максимум результатов) --exclude=(маски через запятую) --max-files=(лимит файлов) --follow-links regex: (регулярные выражения) content: (поиск по содержимому) <текст или маска>\n\n"
+        "/view <имя файла> --page=N --lines=a:b --tail=N --grep=(шаблон) - Посмотреть файл постранично\n"
+        "/tail <имя файла> -n N -f - Последние строки файла, -f — следить за дописыванием\n"
+        "/untail [имя файла] - Остановить слежение\n"
+        "/audit --user=(ID) --cmd=(команда) --since=(2h или дата) --limit=N - Журнал действий\n"
+        "/jobs - Фоновые задачи (cp, mv, rm, search, download, dupes, upload)\n"
+        "/cancel <номер> - Отменить фоновую задачу\n"
+        "/stats [reset] - Время выполнения и ввод-вывод по командам\n"
         "/create <имя_файла> \"текст\"\n"
         "/edit <имя_файла> \"новый_текст\"\n"
-        "/settings - Настройки (дефолтный путь, фильтрация, группировка)\n"
+        "/settings - Настройки (дефолтный путь, фильтрация, группировка, размер страницы /ls)\n"
         "/mv <src> <dst> - Переместить/переименовать\n"
         "/cp <src> <dst> - Скопировать\n"
         "/rm <путь> - Удалить файл/папку\n"
         "/mkdir <имя> - Создать папку\n"
         "/rmdir <имя> - Удалить пустую папку\n"
+        "\nОтправленный боту файл или фото сохраняется в текущую директорию. Подпись: --overwrite "
+        "(заменить), --sha256=(хэш) (проверить), --extract (распаковать архив). Части files.zip.001, ... "
+        "и манифест от /download собираются обратно в архив\n"
         "\nТакже можно вводить команды без слеша, например: cd SomeGame"
     )
     await update.message.reply_text(help_text)
@@ -547,99 +3203,820 @@ async def pwd(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text(f'Текущая директория: {current_dir}')
     log_action(user_id, "pwd", {"cwd": current_dir})
 
-# Команда /download (с поддержкой ZIP)
+# Метод сжатия для файла: в режиме auto уже сжатые форматы не пережимаются
+def zip_compression_for(path, mode):
+    if mode != "auto":
+        return ZIP_COMPRESSION[mode]
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+# Сборка ZIP-архива в буфер (выполняется в пуле потоков). Буфер лежит в памяти до
+# DOWNLOAD_SPOOL_SIZE байт, затем во временном файле системы; удаляется при закрытии.
+# Папки добавляются рекурсивно. Возвращает буфер и список ненайденных имён.
+def build_zip_archive(current_dir, names, mode="auto"):
+    archive = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE)
+    missing = []
+    try:
+        with zipfile.ZipFile(archive, "w") as zipf:
+            for name in names:
+                check_cancelled()
+                full_path = os.path.normpath(os.path.join(current_dir, name))
+                if os.path.isfile(full_path):
+                    report_job_progress(os.path.getsize(full_path), 1)
+                    zipf.write(full_path, arcname=os.path.basename(full_path),
+                               compress_type=zip_compression_for(full_path, mode))
+                elif os.path.isdir(full_path):
+                    base = os.path.dirname(full_path)
+                    for root, dirs, files in os.walk(full_path):
+                        if not dirs and not files:
+                            zipf.write(root, arcname=os.path.relpath(root, base))
+                        for file in files:
+                            check_cancelled()
+                            path = os.path.join(root, file)
+                            report_job_progress(os.path.getsize(path), 1)
+                            zipf.write(path, arcname=os.path.relpath(path, base),
+                                       compress_type=zip_compression_for(path, mode))
+                else:
+                    missing.append(name)
+        archive.seek(0)
+    except BaseException:
+        archive.close()
+        raise
+    return archive, missing
+
+# Незавершённые многотомные загрузки по пользователям (для /download --resume)
+pending_downloads = {}
+
+# Разбиение архива на части не больше part_size байт (выполняется в пуле потоков).
+# Возвращает манифест с размерами и SHA-256 каждой части и всего архива.
+def describe_archive_parts(archive, part_size, name="files.zip"):
+    archive.seek(0)
+    total_hash = hashlib.sha256()
+    parts = []
+    offset = 0
+    while True:
+        part_hash = hashlib.sha256()
+        size = 0
+        while size < part_size:
+            block = archive.read(min(1024 * 1024, part_size - size))
+            if not block:
+                break
+            part_hash.update(block)
+            total_hash.update(block)
+            size += len(block)
+        if not size:
+            break
+        parts.append({
+            "name": f"{name}.{len(parts) + 1:03d}",
+            "offset": offset,
+            "size": size,
+            "sha256": part_hash.hexdigest(),
+        })
+        offset += size
+    return {"name": name, "size": offset, "sha256": total_hash.hexdigest(), "parts": parts}
+
+def read_archive_range(state, offset, size):
+    with state["lock"]:
+        state["archive"].seek(offset)
+        return state["archive"].read(size)
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+# Отправка документа с повторами: RetryAfter выдерживается, прочие ошибки — с растущей паузой
+async def send_document_with_retry(update, data, filename):
+    for attempt in range(DOWNLOAD_UPLOAD_RETRIES):
+        try:
+            return await update.message.reply_document(document=data, filename=filename)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+        except TelegramError as e:
+            if attempt == DOWNLOAD_UPLOAD_RETRIES - 1:
+                raise
+            logger.warning("Повтор отправки %s: %s", filename, e)
+            await asyncio.sleep(2 ** attempt)
+    raise TelegramError(f"Не удалось отправить {filename}")
+
+# Параллельная отправка частей из state["failed"]; неотправленные части остаются там
+async def upload_archive_parts(update, state):
+    semaphore = asyncio.Semaphore(DOWNLOAD_UPLOAD_PARALLELISM)
+    parts = state["manifest"]["parts"]
+
+    async def upload(index):
+        part = parts[index]
+        async with semaphore:
+            try:
+                data = await run_blocking("download", read_archive_range, state, part["offset"], part["size"])
+                await send_document_with_retry(update, data, part["name"])
+                state["failed"].discard(index)
+            except Exception as e:
+                logger.error("Ошибка отправки части %s: %s", part["name"], e)
+
+    await asyncio.gather(*(upload(index) for index in sorted(state["failed"])))
+
+def close_pending_download(user_id):
+    state = pending_downloads.pop(str(user_id), None)
+    if state:
+        state["archive"].close()
+
+# Отправка архива: целиком, если влезает в DOWNLOAD_PART_SIZE, иначе частями с манифестом
+async def send_archive(update, user_id, archive):
+    manifest = await run_blocking("download", describe_archive_parts, archive, DOWNLOAD_PART_SIZE)
+    if len(manifest["parts"]) <= 1:
+        try:
+            archive.seek(0)
+            data = await run_blocking("download", archive.read)
+            await send_document_with_retry(update, data, manifest["name"])
+        finally:
+            archive.close()
+        return True
+    close_pending_download(user_id)
+    state = {
+        "archive": archive,
+        "manifest": manifest,
+        "failed": set(range(len(manifest["parts"]))),
+        "lock": threading.Lock(),
+    }
+    pending_downloads[str(user_id)] = state
+    manifest_data = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+    await send_document_with_retry(update, manifest_data, f"{manifest['name']}.manifest.json")
+    return await resume_archive_upload(update, user_id, state)
+
+async def resume_archive_upload(update, user_id, state):
+    await upload_archive_parts(update, state)
+    if state["failed"]:
+        names = ", ".join(state["manifest"]["parts"][i]["name"] for i in sorted(state["failed"]))
+        await update.message.reply_text(f"Не удалось отправить части: {names}\nПовторить: /download --resume")
+        return False
+    close_pending_download(user_id)
+    await update.message.reply_text(
+        f"Архив отправлен частями: {len(state['manifest']['parts'])}. "
+        "Для сборки объедините части по порядку (cat files.zip.* > files.zip или copy /b)."
+    )
+    return True
+
+# Команда /download (с поддержкой ZIP и папок)
 @authorized_only
+@background_job("download")
 async def download_file(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     files = context.args
+    if files == ["--resume"]:
+        state = pending_downloads.get(str(user_id))
+        if not state:
+            await update.message.reply_text("Нет незавершённой загрузки.")
+            return
+        sent = await resume_archive_upload(update, user_id, state)
+        log_action(user_id, "download", {"resume": True, "complete": sent})
+        return
+    mode = "auto"
+    for arg in list(files):
+        if arg.startswith("--compress="):
+            mode = arg.split("=", 1)[1].lower()
+            files = [f for f in files if f != arg]
     if not files:
         await update.message.reply_text("Укажите имя(я) файла(ов) после команды /download")
         return
+    if mode != "auto" and mode not in ZIP_COMPRESSION:
+        await update.message.reply_text(f"Метод сжатия должен быть: auto, {', '.join(ZIP_COMPRESSION)}")
+        return
 
     current_dir = get_current_dir(user_id)
-    zip_path = os.path.join(current_dir, f"user_{user_id}_files.zip")
 
     # Создаем ZIP-архив
-    with zipfile.ZipFile(zip_path, "w") as zipf:
-        for file_name in files:
-            full_path = os.path.join(current_dir, file_name)
-            if os.path.isfile(full_path):
-                zipf.write(full_path, arcname=file_name)
-            else:
-                await update.message.reply_text(f"Файл не найден: {file_name}")
+    try:
+        archive, missing = await run_blocking("download", build_zip_archive, current_dir, files, mode)
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка создания архива: {e}")
+        log_action(user_id, "download", {"error": str(e), "files": files})
+        return
+    for file_name in missing:
+        await update.message.reply_text(f"Файл не найден: {file_name}")
 
     # Отправляем ZIP-архив
-    if os.path.getsize(zip_path) > 0:
-        with open(zip_path, "rb") as zf:
-            await update.message.reply_document(document=zf, filename="files.zip")
-        log_action(user_id, "download", {"files": files})
-    else:
+    if len(missing) == len(files):
+        archive.close()
         await update.message.reply_text("Нет файлов для скачивания.")
+        return
+    try:
+        sent = await send_archive(update, user_id, archive)
+        log_action(user_id, "download", {"files": files, "compress": mode, "complete": sent})
+    except Exception as e:
+        if pending_downloads.get(str(user_id), {}).get("archive") is not archive:
+            archive.close()
+        await update.message.reply_text(f"Ошибка отправки архива: {e}")
+        log_action(user_id, "download", {"error": str(e), "files": files})
+
+# Загрузка файлов из чата (документы и фото) в текущую директорию. Файл пишется потоком
+# во временный файл рядом с целевым и переименовывается, только когда записан и проверен.
+# Части name.zip.001, name.zip.002, ... от /download собираются, когда загружены все части
+# и манифест name.zip.manifest.json; каждая часть и весь архив сверяются по SHA-256.
+UPLOAD_PART_RE = re.compile(r"^(.+)\.\d{3}$")
+MANIFEST_SUFFIX = ".manifest.json"
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+def open_upload_temp(directory):
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    return os.fdopen(fd, "wb"), temp_path
+
+def write_upload_chunk(f, digest, chunk):
+    check_cancelled()
+    f.write(chunk)
+    digest.update(chunk)
+    report_job_progress(len(chunk))
+
+# Копирование файла, который локальный сервер Bot API уже сохранил на диск
+def copy_local_upload(source, f, digest):
+    with open(source, "rb") as src:
+        while True:
+            chunk = src.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            write_upload_chunk(f, digest, chunk)
+
+# Запись на диск и переименование во временный файл на месте целевого (атомарная замена)
+def commit_upload(f, temp_path, target):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    if os.path.exists(target):
+        shutil.copymode(target, temp_path)
+    else:
+        os.chmod(temp_path, 0o644)
+    os.replace(temp_path, target)
+
+def discard_upload(f, temp_path):
+    f.close()
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+
+# Скачивание файла Telegram в target без буферизации всего файла в памяти
+async def stream_upload(tg_file, target, expected_size=None, expected_sha256=None):
+    f, temp_path = await run_blocking("upload", open_upload_temp, os.path.dirname(target))
+    digest = hashlib.sha256()
+    try:
+        if TELEGRAM_LOCAL_MODE:
+            await run_blocking("upload", copy_local_upload, tg_file.file_path, f, digest)
+        else:
+            async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
+                async with client.stream("GET", tg_file.file_path) as response:
+                    # В адресе файла есть токен бота, поэтому в ошибку попадает только код ответа
+                    if response.status_code != 200:
+                        raise ValueError(f"сервер Telegram ответил {response.status_code}")
+                    async for chunk in response.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                        await run_blocking("upload", write_upload_chunk, f, digest, chunk)
+        size = f.tell()
+        if expected_size is not None and size != expected_size:
+            raise ValueError(f"получено {size} байт вместо {expected_size}")
+        if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+            raise ValueError("контрольная сумма SHA-256 не совпадает")
+        await run_blocking("upload", commit_upload, f, temp_path, target)
+    except BaseException:
+        await asyncio.shield(run_blocking("upload", discard_upload, f, temp_path))
+        raise
+    return size, digest.hexdigest()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            check_cancelled()
+            block = f.read(UPLOAD_CHUNK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+# Манифест /download рядом с частями или None, если его нет или это не манифест
+def read_upload_manifest(directory, name):
+    try:
+        with open(os.path.join(directory, name + MANIFEST_SUFFIX), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if all(isinstance(part.get("name"), str) for part in manifest["parts"]) and manifest["sha256"]:
+            return manifest
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return None
 
-    # Удаляем временный ZIP-файл
-    os.remove(zip_path)
+# Имя архива, если загруженный файл — часть из манифеста, который уже лежит в папке
+def upload_part_archive(directory, name):
+    part = UPLOAD_PART_RE.match(name)
+    if not part:
+        return None
+    manifest = read_upload_manifest(directory, part.group(1))
+    if manifest and name in {p["name"] for p in manifest["parts"]}:
+        return part.group(1)
+    return None
+
+# Сборка архива из частей по манифесту (выполняется в пуле потоков).
+# Возвращает (путь архива или None, список недостающих или повреждённых частей).
+# Существующий файл с именем архива заменяется только при overwrite.
+def assemble_upload_parts(directory, name, overwrite=False):
+    manifest_path = os.path.join(directory, name + MANIFEST_SUFFIX)
+    manifest = read_upload_manifest(directory, name)
+    if manifest is None:
+        return None, [name + MANIFEST_SUFFIX]
+    parts = manifest["parts"]
+    missing = []
+    for part in parts:
+        try:
+            if os.path.getsize(os.path.join(directory, part["name"])) != part["size"]:
+                missing.append(part["name"])
+        except FileNotFoundError:
+            missing.append(part["name"])
+    if missing:
+        return None, missing
+    target = os.path.join(directory, name)
+    if os.path.lexists(target) and not overwrite:
+        raise FileExistsError(f"файл {name} уже существует, отправьте манифест с подписью --overwrite, чтобы заменить его")
+    broken = [part["name"] for part in parts if file_sha256(os.path.join(directory, part["name"])) != part["sha256"]]
+    if broken:
+        return None, broken
+    f, temp_path = open_upload_temp(directory)
+    digest = hashlib.sha256()
+    try:
+        for part in parts:
+            copy_local_upload(os.path.join(directory, part["name"]), f, digest)
+        if digest.hexdigest() != manifest["sha256"]:
+            raise ValueError("контрольная сумма собранного архива не совпадает с манифестом")
+        commit_upload(f, temp_path, target)
+    except BaseException:
+        discard_upload(f, temp_path)
+        raise
+    for part in parts:
+        os.remove(os.path.join(directory, part["name"]))
+    os.remove(manifest_path)
+    return target, []
+
+def is_within(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+# Распаковка архива в новую папку рядом с ним (выполняется в пуле потоков). Пути, ведущие
+# за пределы папки (zip slip), абсолютные пути и ссылки наружу отклоняются; распаковка идёт
+# во временную папку, которая переименовывается только после успешного завершения.
+def extract_archive(path):
+    directory, name = os.path.split(path)
+    suffix = next(s for s in ARCHIVE_SUFFIXES if name.lower().endswith(s))
+    base = name[:-len(suffix)] or "archive"
+    destination = os.path.join(directory, base)
+    counter = 1
+    while os.path.exists(destination):
+        counter += 1
+        destination = os.path.join(directory, f"{base}_{counter}")
+    temp_dir = tempfile.mkdtemp(dir=directory, prefix=".extract-")
+    root = os.path.realpath(temp_dir)
+    count = 0
+    try:
+        if suffix == ".zip":
+            with zipfile.ZipFile(path) as zf:
+                for info in zf.infolist():
+                    check_cancelled()
+                    if not is_within(os.path.realpath(os.path.join(root, info.filename)), root):
+                        raise ValueError(f"небезопасный путь в архиве: {info.filename}")
+                    zf.extract(info, root)
+                    count += 1
+        else:
+            with tarfile.open(path) as tf:
+                for member in tf:
+                    check_cancelled()
+                    member_path = os.path.realpath(os.path.join(root, member.name))
+                    if not is_within(member_path, root):
+                        raise ValueError(f"небезопасный путь в архиве: {member.name}")
+                    if member.issym() or member.islnk():
+                        link_base = os.path.dirname(member_path) if member.issym() else root
+                        if not is_within(os.path.realpath(os.path.join(link_base, member.linkname)), root):
+                            raise ValueError(f"ссылка за пределы архива: {member.name}")
+                    elif not (member.isfile() or member.isdir()):
+                        continue
+                    if hasattr(tarfile, "data_filter"):
+                        tf.extract(member, root, filter="data")
+                    else:
+                        tf.extract(member, root)
+                    count += 1
+        os.chmod(temp_dir, 0o755)
+        os.rename(temp_dir, destination)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return destination, count
 
-# Команда /ls
+# Приём документа или фото. Подпись к файлу: --extract / --no-extract (распаковать архив),
+# --sha256=<хэш> (проверить контрольную сумму), --overwrite (заменить существующий файл)
 @authorized_only
-async def ls(update: Update, context: CallbackContext) -> None:
+@background_job("upload")
+async def upload_file(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
+    message = update.message
+    options = (message.caption or "").split()
+    extract = (UPLOAD_EXTRACT or "--extract" in options) and "--no-extract" not in options
+    expected_sha256 = next((o.split("=", 1)[1] for o in options if o.startswith("--sha256=")), None)
+    if message.document:
+        attachment = message.document
+        name = os.path.basename((attachment.file_name or "").replace("\\", "/"))
+    else:
+        attachment = message.photo[-1]
+        name = f"photo_{attachment.file_unique_id}.jpg"
+    if name in ("", ".", ".."):
+        name = f"file_{attachment.file_unique_id}"
+    job = current_job.get()
+    if job is not None:
+        job["title"] = f"upload {name}"
+
     current_dir = get_current_dir(user_id)
+    target = os.path.join(current_dir, name)
+    overwrite = "--overwrite" in options
+    # Часть считается частью архива, только если её манифест уже загружен; такие части
+    # заменяются без вопросов, чтобы повреждённую можно было перезалить
+    archive_name = await run_blocking("upload", upload_part_archive, current_dir, name)
+    if archive_name is None and not overwrite and await run_blocking("upload", os.path.lexists, target):
+        await message.reply_text(f"Файл {name} уже существует. Отправьте его с подписью --overwrite, чтобы заменить.")
+        return
     try:
-        items = os.listdir(current_dir)
-        item_list = []
-        for item in items:
-            full_path = os.path.join(current_dir, item)
-            is_dir = os.path.isdir(full_path)
-            mtime = os.path.getmtime(full_path)
-            ext = os.path.splitext(item)[1].lower()
+        tg_file = await attachment.get_file()
+        size, sha256 = await stream_upload(tg_file, target, attachment.file_size, expected_sha256)
+    except (JobCancelled, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        await message.reply_text(f"Ошибка загрузки {name}: {e}")
+        log_action(user_id, "upload", {"error": str(e), "file": target})
+        return
+    invalidate_index()
+    await message.reply_text(f"Файл сохранён: {target} ({human_size(size)})")
+    log_action(user_id, "upload", {"file": target, "size": size, "sha256": sha256})
+
+    if archive_name is None and name.endswith(MANIFEST_SUFFIX):
+        archive_name = name[:-len(MANIFEST_SUFFIX)]
+        if await run_blocking("upload", read_upload_manifest, current_dir, archive_name) is None:
+            archive_name = None
+    if archive_name is not None:
+        try:
+            assembled, missing = await run_blocking(
+                "upload", assemble_upload_parts, current_dir, archive_name, overwrite
+            )
+        except (JobCancelled, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            await message.reply_text(f"Ошибка сборки {archive_name}: {e}")
+            log_action(user_id, "upload", {"error": str(e), "assemble": archive_name})
+            return
+        if assembled is None:
+            await message.reply_text(f"Для сборки {archive_name} не хватает: {', '.join(missing)}")
+            return
+        target = assembled
+        invalidate_index()
+        await message.reply_text(f"Архив собран из частей: {target}")
+        log_action(user_id, "upload", {"assembled": target})
+
+    if extract and target.lower().endswith(ARCHIVE_SUFFIXES):
+        try:
+            destination, count = await run_blocking("upload", extract_archive, target)
+        except (JobCancelled, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            await message.reply_text(f"Ошибка распаковки {os.path.basename(target)}: {e}")
+            log_action(user_id, "upload", {"error": str(e), "extract": target})
+            return
+        invalidate_index()
+        await message.reply_text(f"Архив распакован в {destination} (элементов: {count})")
+        log_action(user_id, "upload", {"extract": target, "to": destination, "count": count})
+
+# Кэш содержимого директорий для /ls по mtime директории: повторный /ls неизменённой папки
+# стоит одного stat. Изменение содержимого файла mtime папки не меняет, поэтому правки
+# через бота сбрасывают кэш явно (invalidate_index).
+listing_cache = OrderedDict()
+listing_lock = threading.Lock()
+
+def human_size(size):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Чтение содержимого директории (выполняется в пуле потоков).
+# os.scandir отдаёт тип записи без stat, а DirEntry.stat() — не больше одного вызова на запись.
+def list_directory_items(current_dir):
+    st = os.stat(current_dir)
+    with listing_lock:
+        cached = listing_cache.get(current_dir)
+        if cached and cached[0] == st.st_mtime_ns:
+            listing_cache.move_to_end(current_dir)
+            return cached[1], cached[2]
+    items = []
+    item_list = []
+    with os.scandir(current_dir) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                entry_st = entry.stat()
+            except OSError:
+                # Битая ссылка: берём данные самой ссылки
+                is_dir = False
+                entry_st = entry.stat(follow_symlinks=False)
+            ext = os.path.splitext(entry.name)[1].lower()
             emoji = EMOJI_MAP.get(ext, "📄") if not is_dir else "📂"
-            item_list.append({"name": item, "is_dir": is_dir, "mtime": mtime, "emoji": emoji})
-        settings = get_user_settings(user_id)
-        filtering = settings.get("filtering", "off")
-        grouping = settings.get("grouping", "off")
-        if filtering == "name":
-            item_list.sort(key=lambda x: x["name"].lower())
-        elif filtering == "date":
-            item_list.sort(key=lambda x: x["mtime"], reverse=True)
-        else:
-            item_list.sort(key=lambda x: x["name"].lower())
-        if grouping == "date":
-            groups = {}
-            now = datetime.now()
-            date_ranges = {
-                "Сегодня": now.date(),
-                "Ранее на этой неделе": now.date() - timedelta(days=now.weekday()),
-                "На прошлой неделе": now.date() - timedelta(days=now.weekday() + 7),
-                "Ранее в этом месяце": now.replace(day=1).date(),
-                "В прошлом месяце": (now.replace(day=1) - timedelta(days=1)).replace(day=1).date(),
-                "Давно": datetime.min.date(),
-            }
-            for item in item_list:
-                item_date = datetime.fromtimestamp(item["mtime"]).date()
-                for label, start_date in date_ranges.items():
-                    if item_date >= start_date:
-                        groups.setdefault(label, []).append(item)
-                        break
-            output_blocks = []
-            for label in date_ranges.keys():
-                if label in groups:
-                    block = f"```\n{label}:\n"
-                    block += "\n".join([f"  {item['emoji']} {item['name']}" for item in groups[label]])
-                    block += "\n```"
-                    output_blocks.append(block)
-            final_text = "\n".join(output_blocks)
-        else:
-            folders = [f"{item['emoji']} {item['name']}" for item in item_list if item["is_dir"]]
-            files = [f"{item['emoji']} {item['name']}" for item in item_list if not item["is_dir"]]
-            block1 = "```\nFolders:\n" + "\n".join(folders) + "\n```" if folders else ""
-            block2 = "```\nFiles:\n" + "\n".join(files) + "\n```" if files else ""
-            final_text = "\n".join(filter(None, [block1, block2]))
-        await update.message.reply_text(final_text, parse_mode="Markdown")
+            items.append(entry.name)
+            item_list.append({
+                "name": entry.name,
+                "is_dir": is_dir,
+                "mtime": entry_st.st_mtime,
+                "size": 0 if is_dir else entry_st.st_size,
+                "emoji": emoji,
+            })
+    # Папку, изменённую только что, не кэшируем: ещё одно изменение в пределах
+    # точности mtime файловой системы осталось бы незамеченным
+    if time.time() - st.st_mtime > 2:
+        with listing_lock:
+            listing_cache[current_dir] = (st.st_mtime_ns, items, item_list)
+            while len(listing_cache) > LISTING_CACHE_SIZE:
+                listing_cache.popitem(last=False)
+    return items, item_list
+
+# Итоговая строка /ls: число папок и файлов, общий размер файлов
+def listing_summary(item_list):
+    folders = sum(1 for item in item_list if item["is_dir"])
+    total = sum(item["size"] for item in item_list)
+    return f"Папок: {folders}, файлов: {len(item_list) - folders}, размер: {human_size(total)}"
+
+# Сортировка и группировка содержимого по настройкам пользователя.
+# Результат — плоский список строк (заголовок группы, элемент) для постраничного вывода.
+def build_listing_rows(item_list, filtering, grouping):
+    item_list = list(item_list)
+    if filtering == "date":
+        item_list.sort(key=lambda x: x["mtime"], reverse=True)
+    else:
+        item_list.sort(key=lambda x: x["name"].lower())
+    if grouping == "date":
+        groups = {}
+        now = datetime.now()
+        date_ranges = {
+            "Сегодня": now.date(),
+            "Ранее на этой неделе": now.date() - timedelta(days=now.weekday()),
+            "На прошлой неделе": now.date() - timedelta(days=now.weekday() + 7),
+            "Ранее в этом месяце": now.replace(day=1).date(),
+            "В прошлом месяце": (now.replace(day=1) - timedelta(days=1)).replace(day=1).date(),
+            "Давно": datetime.min.date(),
+        }
+        for item in item_list:
+            item_date = datetime.fromtimestamp(item["mtime"]).date()
+            for label, start_date in date_ranges.items():
+                if item_date >= start_date:
+                    groups.setdefault(label, []).append(item)
+                    break
+        return [(label, item) for label in date_ranges if label in groups for item in groups[label]]
+    rows = [("Folders", item) for item in item_list if item["is_dir"]]
+    rows += [("Files", item) for item in item_list if not item["is_dir"]]
+    return rows
+
+def format_listing_row(item, indent):
+    return f"{'  ' if indent else ''}{item['emoji']} {item['name']}"
+
+# Разбиение строк на страницы: не больше page_size строк и не больше max_chars символов текста,
+# чтобы длинные имена не обрезались и ни одна запись не выпадала между страницами.
+# Возвращает индексы начала страниц.
+def paginate_listing(rows, page_size, indent, max_chars):
+    starts = [0]
+    length = 0
+    count = 0
+    label = None
+    for index, (row_label, item) in enumerate(rows):
+        added = len(format_listing_row(item, indent)) + 1
+        if row_label != label:
+            # Новый блок: "```\n<метка>:" + "\n```" и перевод строки между блоками
+            added += len(row_label) + 10
+        if count and (count >= page_size or length + added > max_chars):
+            starts.append(index)
+            length = 0
+            count = 0
+            label = None
+            added = len(format_listing_row(item, indent)) + len(row_label) + 11
+        length += added
+        count += 1
+        label = row_label
+    return starts
+
+# Сессии /ls: отсортированный список считается один раз и переиспользуется при листании
+# в течение LS_SESSION_TTL секунд
+ls_sessions = {}
+
+async def open_ls_session(user_id, current_dir):
+    items, item_list = await run_blocking("ls", list_directory_items, current_dir)
+    settings = get_user_settings(user_id)
+    grouping = settings.get("grouping", "off")
+    rows = build_listing_rows(item_list, settings.get("filtering", "off"), grouping)
+    summary = listing_summary(item_list)
+    # Место под подвал «Страница N/M · сводка» и запас
+    max_chars = 4096 - len(summary) - 64
+    session = {
+        "id": ls_sessions.get(str(user_id), {}).get("id", 0) + 1,
+        "dir": current_dir,
+        "rows": rows,
+        "indent": grouping == "date",
+        "summary": summary,
+        "pages": paginate_listing(rows, settings.get("page_size") or LS_PAGE_SIZE, grouping == "date", max_chars),
+        "created": time.monotonic(),
+    }
+    ls_sessions[str(user_id)] = session
+    return session, items
+
+# Отрисовка одной страницы: только видимые строки и клавиатура навигации
+def render_ls_page(session, page):
+    rows = session["rows"]
+    starts = session["pages"]
+    pages = len(starts)
+    page = min(max(page, 0), pages - 1)
+    end = starts[page + 1] if page + 1 < pages else len(rows)
+    blocks = []
+    label = None
+    for row_label, item in rows[starts[page]:end]:
+        if row_label != label:
+            label = row_label
+            blocks.append([f"{label}:"])
+        blocks[-1].append(format_listing_row(item, session["indent"]))
+    text = "\n".join("```\n" + "\n".join(block) + "\n```" for block in blocks)
+    footer = session["summary"]
+    if pages > 1:
+        footer = f"Страница {page + 1}/{pages} · {footer}"
+    text = "\n".join(filter(None, [text, footer]))
+    if pages == 1:
+        return text, None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⏮", callback_data=f"ls:{session['id']}:0"))
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"ls:{session['id']}:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"ls:{session['id']}:{page + 1}"))
+        buttons.append(InlineKeyboardButton("⏭", callback_data=f"ls:{session['id']}:{pages - 1}"))
+    return text, InlineKeyboardMarkup([buttons])
+
+# Команда /ls [--page=N]
+@authorized_only
+async def ls(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    current_dir = get_current_dir(user_id)
+    page = 0
+    for arg in context.args or []:
+        if arg.startswith("--page=") and arg.split("=", 1)[1].isdigit():
+            page = max(1, int(arg.split("=", 1)[1])) - 1
+    try:
+        session, items = await open_ls_session(user_id, current_dir)
+        text, markup = render_ls_page(session, page)
+        await update.message.reply_text(text, parse_mode="Markdown", reply_markup=markup)
         log_action(user_id, "ls", {"cwd": current_dir, "items": items})
     except Exception as e:
         await update.message.reply_text(f"Ошибка: {e}")
         log_action(user_id, "ls", {"error": str(e)})
 
+# Кнопки навигации /ls
+@authorized_only
+async def ls_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    user_id = update.effective_user.id
+    try:
+        _, session_id, page = query.data.split(":")
+        session = ls_sessions.get(str(user_id))
+        if not session or session["id"] != int(session_id):
+            await query.answer("Список устарел, выполните /ls заново.")
+            return
+        if time.monotonic() - session["created"] > LS_SESSION_TTL:
+            # Кэш устарел — пересчитываем ту же папку, сохраняя номер сессии для кнопок
+            session_id = session["id"]
+            session, _ = await open_ls_session(user_id, session["dir"])
+            session["id"] = session_id
+        text, markup = render_ls_page(session, int(page))
+        await query.answer()
+        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=markup)
+    except Exception as e:
+        await query.answer(f"Ошибка: {e}")
+
+# Кэш для /du: для каждой папки — (mtime, размер и число её файлов, подпапки).
+# Папки, чей mtime не изменился, повторно не читаются: при повторном /du сканируются
+# только изменённые поддеревья. Дозапись в существующий файл mtime папки не меняет,
+# для точного пересчёта есть --rescan.
+du_cache = OrderedDict()
+du_lock = threading.Lock()
+
+def du_read_dir(path, rescan=False):
+    st = os.stat(path)
+    with du_lock:
+        cached = du_cache.get(path)
+    if cached and cached[0] == st.st_mtime_ns and not rescan:
+        return cached
+    size = 0
+    files = 0
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+                    files += 1
+            except OSError:
+                continue
+    record = (st.st_mtime_ns, size, files, subdirs)
+    if time.time() - st.st_mtime > 2:
+        with du_lock:
+            du_cache[path] = record
+            du_cache.move_to_end(path)
+            while len(du_cache) > DU_CACHE_SIZE:
+                du_cache.popitem(last=False)
+    return record
+
+# Размер поддерева (выполняется в пуле потоков). Возвращает общий размер, число файлов
+# и итоги по папкам не глубже depth уровней от top (сама top — уровень 0).
+def du_tree(top, depth, rescan=False):
+    stack = [(top, 0, False)]
+    records = {}
+    totals = {}
+    reported = []
+    while stack:
+        path, level, done = stack.pop()
+        if not done:
+            try:
+                records[path] = du_read_dir(path, rescan)
+            except OSError:
+                totals[path] = (0, 0)
+                continue
+            stack.append((path, level, True))
+            stack.extend((sub, level + 1, False) for sub in records[path][3])
+            continue
+        _, size, files, subdirs = records.pop(path)
+        for sub in subdirs:
+            sub_size, sub_files = totals.pop(sub, (0, 0))
+            size += sub_size
+            files += sub_files
+        totals[path] = (size, files)
+        if level <= depth:
+            reported.append((path, size, files))
+    size, files = totals[top]
+    return size, files, reported
+
+# Команда /du [путь] [--top=N] [--depth=N] [--rescan]
+@authorized_only
+async def du(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    usage = "Использование: /du [путь] [--top=N] [--depth=N] [--rescan]"
+    top = 15
+    depth = 1
+    rescan = False
+    args = []
+    try:
+        for arg in context.args:
+            if arg.startswith("--top="):
+                top = max(1, int(arg.split("=", 1)[1]))
+            elif arg.startswith("--depth="):
+                depth = max(1, int(arg.split("=", 1)[1]))
+            elif arg == "--rescan":
+                rescan = True
+            else:
+                args.append(arg)
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    current_dir = get_current_dir(user_id)
+    target = os.path.normpath(os.path.join(current_dir, " ".join(args))) if args else current_dir
+    if not await run_blocking("du", os.path.isdir, target):
+        await update.message.reply_text("Указанная директория не существует.")
+        return
+    started = time.monotonic()
+    try:
+        _, own_size, own_files, subdirs = await run_blocking("du", du_read_dir, target, rescan)
+        # Поддеревья верхнего уровня считаются параллельно (не больше лимита команды du)
+        results = await asyncio.gather(*(run_blocking("du", du_tree, sub, depth - 1, rescan) for sub in subdirs))
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+        log_action(user_id, "du", {"error": str(e), "path": target})
+        return
+    total_size = own_size + sum(r[0] for r in results)
+    total_files = own_files + sum(r[1] for r in results)
+    entries = [entry for r in results for entry in r[2]]
+    if own_files:
+        entries.append((os.path.join(target, "."), own_size, own_files))
+    entries.sort(key=lambda e: e[1], reverse=True)
+    header = (
+        f"{target}\nВсего: {human_size(total_size)}, файлов: {total_files}, "
+        f"папок: {len(subdirs)} ({time.monotonic() - started:.1f} с)"
+    )
+    lines = []
+    length = len(header)
+    for path, size, files in entries[:top]:
+        name = os.path.relpath(path, target)
+        share = size * 100 / total_size if total_size else 0
+        line = f"{human_size(size):>10} {share:5.1f}% {files:>8}  {name}"
+        if length + len(line) > 3900:
+            lines.append("…")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    text = "```\n" + "\n".join([header, ""] + lines).replace("`", "'") + "\n```"
+    await update.message.reply_text(text, parse_mode="Markdown")
+    log_action(user_id, "du", {"path": target, "size": total_size, "files": total_files, "depth": depth})
+
 @authorized_only
 async def cd(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
@@ -652,15 +4029,57 @@ async def cd(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("Укажите путь после команды cd или установите дефолтный путь через /settings")
         return
     path = ' '.join(context.args)
+    if path == "-":
+        await previous_directory(update, context)
+        return
+    if re.fullmatch(r"-\d+", path):
+        recent = get_session(user_id)["recent"]
+        index = int(path[1:])
+        if index >= len(recent):
+            await update.message.reply_text("Нет такой записи в /history.")
+            return
+        path = recent[index]
     await change_directory(update, context, path)
 
+# Возврат в предыдущую директорию (`cd -`): повторный вызов возвращает обратно
+async def previous_directory(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    session = get_session(user_id)
+    current_dir = get_current_dir(user_id)
+    while session["history"]:
+        target = session["history"].pop()
+        if await run_blocking("cd", os.path.isdir, target):
+            session["history"].append(current_dir)
+            set_current_dir(user_id, target, remember=False)
+            await update.message.reply_text(f'Текущая директория изменена на: {target}')
+            log_action(user_id, "cd", {"from": current_dir, "to": target})
+            return
+    dirty_state.add(("user_sessions", str(user_id)))
+    schedule_state_flush()
+    await update.message.reply_text('История переходов пуста.')
+
+@authorized_only
+async def history(update: Update, context: CallbackContext) -> None:
+    """Недавние директории; перейти к записи N можно через `cd -N`."""
+    user_id = update.effective_user.id
+    session = get_session(user_id)
+    current_dir = get_current_dir(user_id)
+    recent = session["recent"]
+    if not recent:
+        await update.message.reply_text("История переходов пуста.")
+        return
+    lines = [f"{i}. {p}" + (" ← текущая" if p == current_dir else "") for i, p in enumerate(recent)]
+    text = "Недавние директории (перейти: cd -N, предыдущая: cd -):\n" + "\n".join(lines)
+    await update.message.reply_text(text)
+    log_action(user_id, "history", {"count": len(recent)})
+
 @authorized_only
 async def back(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     current_dir = get_current_dir(user_id)
     parent_dir = os.path.dirname(current_dir)
     if parent_dir and parent_dir != current_dir:
-        current_dirs[str(user_id)] = parent_dir
+        set_current_dir(user_id, parent_dir)
         await update.message.reply_text(f'Теперь вы в: {parent_dir}')
         log_action(user_id, "back", {"from": current_dir, "to": parent_dir})
     else:
@@ -674,6 +4093,7 @@ async def settings_command(update: Update, context: CallbackContext) -> None:
       • default_path <путь> – установить дефолтный путь для cd (без аргументов).
       • filtering <name/date/off> – установить режим фильтрации.
       • grouping <date/off> – установить режим группировки.
+      • page_size <N> – число записей на странице /ls.
     """
     user_id = update.effective_user.id
     settings = get_user_settings(user_id)
@@ -683,10 +4103,12 @@ async def settings_command(update: Update, context: CallbackContext) -> None:
         text += f"Дефолтный путь: {settings.get('default_path')}\n"
         text += f"Фильтрация: {settings.get('filtering')}\n"
         text += f"Группировка: {settings.get('grouping')}\n"
+        text += f"Записей на странице /ls: {settings.get('page_size') or LS_PAGE_SIZE}\n"
         text += "\nИспользуйте:\n"
         text += "/settings default_path <путь>\n"
         text += "/settings filtering <name/date/off>\n"
         text += "/settings grouping <date/off>\n"
+        text += "/settings page_size <N>\n"
         await update.message.reply_text(text)
         log_action(user_id, "settings", {"action": "show", "settings": settings})
         return
@@ -699,7 +4121,7 @@ async def settings_command(update: Update, context: CallbackContext) -> None:
             settings["default_path"] = new_default
             await update.message.reply_text(f"Дефолтный путь установлен: {new_default}")
             log_action(user_id, "settings", {"default_path": new_default})
-            save_settings_db()
+            save_settings_db(user_id)
     elif subcommand == "filtering":
         if len(args) < 2:
             await update.message.reply_text("Укажите режим фильтрации: name, date или off, например: /settings filtering name")
@@ -711,7 +4133,7 @@ async def settings_command(update: Update, context: CallbackContext) -> None:
         settings["filtering"] = mode
         await update.message.reply_text(f"Режим фильтрации установлен: {mode}")
         log_action(user_id, "settings", {"filtering": mode})
-        save_settings_db()
+        save_settings_db(user_id)
     elif subcommand == "grouping":
         if len(args) < 2:
             await update.message.reply_text("Укажите режим группировки: date или off, например: /settings grouping date")
@@ -723,9 +4145,17 @@ async def settings_command(update: Update, context: CallbackContext) -> None:
         settings["grouping"] = mode
         await update.message.reply_text(f"Режим группировки установлен: {mode}")
         log_action(user_id, "settings", {"grouping": mode})
-        save_settings_db()
+        save_settings_db(user_id)
+    elif subcommand == "page_size":
+        if len(args) < 2 or not args[1].isdigit() or not 1 <= int(args[1]) <= 200:
+            await update.message.reply_text("Укажите число записей на странице от 1 до 200, например: /settings page_size 30")
+            return
+        settings["page_size"] = int(args[1])
+        await update.message.reply_text(f"Записей на странице /ls: {settings['page_size']}")
+        log_action(user_id, "settings", {"page_size": settings["page_size"]})
+        save_settings_db(user_id)
     else:
-        await update.message.reply_text("Неизвестная настройка. Используйте default_path, filtering или grouping.")
+        await update.message.reply_text("Неизвестная настройка. Используйте default_path, filtering, grouping или page_size.")
         log_action(user_id, "settings", {"error": "Неизвестная настройка", "args": args})
 
 # Обработчик текстовых сообщений (без слеша)
@@ -742,18 +4172,36 @@ async def text_handler(update: Update, context: CallbackContext) -> None:
         await cd(update, context)
     elif command == 'ls':
         await ls(update, context)
+    elif command == 'du':
+        await du(update, context)
+    elif command == 'dupes':
+        await dupes(update, context)
     elif command == 'pwd':
         await pwd(update, context)
     elif command == 'help':
         await help_command(update, context)
     elif command == 'back':
         await back(update, context)
+    elif command == 'history':
+        await history(update, context)
     elif command == 'download':
         await download_file(update, context)
     elif command == 'search':
         await search(update, context)
     elif command == 'view':
         await view_file(update, context)
+    elif command == 'tail':
+        await tail(update, context)
+    elif command == 'untail':
+        await untail(update, context)
+    elif command == 'audit':
+        await audit(update, context)
+    elif command == 'jobs':
+        await jobs_command(update, context)
+    elif command == 'stats':
+        await stats_command(update, context)
+    elif command == 'cancel':
+        await cancel_job(update, context)
     elif command == 'create':
         await create_file(update, context)
     elif command == 'edit':
@@ -774,9 +4222,34 @@ async def text_handler(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text('Неизвестная команда.')
         log_action(update.effective_user.id, "unknown", {"text": text})
 
+# Освобождение ресурсов при остановке бота
+async def on_startup(app: Application) -> None:
+    await start_stats_exporters()
+
+async def on_shutdown(app: Application) -> None:
+    stop_stats_exporters()
+    stop_tail_watchers()
+    cancel_all_jobs()
+    flush_state_db()
+    shutdown_executors()
+    action_log.close()
+    if debug_log:
+        debug_log.close()
+
 def main() -> None:
     load_settings_db()
-    app = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        api_url = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot").local_mode(TELEGRAM_LOCAL_MODE)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
@@ -784,9 +4257,20 @@ def main() -> None:
     app.add_handler(CommandHandler("ls", ls))
     app.add_handler(CommandHandler("cd", cd))
     app.add_handler(CommandHandler("back", back))
+    app.add_handler(CommandHandler("du", du))
+    app.add_handler(CommandHandler("dupes", dupes))
+    app.add_handler(CommandHandler("jobs", jobs_command))
+    app.add_handler(CommandHandler("cancel", cancel_job))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("history", history))
     app.add_handler(CommandHandler("download", download_file))
     app.add_handler(CommandHandler("search", search))
     app.add_handler(CommandHandler("view", view_file))
+    app.add_handler(CallbackQueryHandler(view_callback, pattern=r"^view:"))
+    app.add_handler(CallbackQueryHandler(ls_callback, pattern=r"^ls:"))
+    app.add_handler(CommandHandler("tail", tail))
+    app.add_handler(CommandHandler("untail", untail))
+    app.add_handler(CommandHandler("audit", audit))
     app.add_handler(CommandHandler("create", create_file))
     app.add_handler(CommandHandler("edit", edit_file))
     app.add_handler(CommandHandler("settings", settings_command))
@@ -796,6 +4280,7 @@ def main() -> None:
     app.add_handler(CommandHandler("mkdir", mkdir))
     app.add_handler(CommandHandler("rmdir", rmdir))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), text_handler))
+    app.add_handler(MessageHandler(filters.Document.ALL | filters.PHOTO, upload_file))
 
     commands = [
         BotCommand("start", "Начать"),
@@ -804,8 +4289,18 @@ def main() -> None:
         BotCommand("ls", "Показать содержимое директории"),
         BotCommand("cd", "Сменить директорию"),
         BotCommand("back", "Вернуться на уровень выше"),
+        BotCommand("du", "Размер папок"),
+        BotCommand("dupes", "Поиск дубликатов"),
+        BotCommand("history", "Недавние директории"),
         BotCommand("download", "Скачать файл"),
         BotCommand("search", "Поиск файлов"),
+        BotCommand("view", "Просмотреть файл"),
+        BotCommand("tail", "Конец файла / слежение (-f)"),
+        BotCommand("untail", "Остановить слежение"),
+        BotCommand("audit", "Журнал действий"),
+        BotCommand("jobs", "Фоновые задачи"),
+        BotCommand("cancel", "Отменить задачу"),
+        BotCommand("stats", "Статистика команд"),
         BotCommand("create", "Создать файл"),
         BotCommand("edit", "Редактировать файл"),
         BotCommand("settings", "Настройки"),
@@ -822,4 +4317,8 @@ def main() -> None:
     app.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # python main.py import-logs <файлы...> — загрузка старых JSONL-журналов в базу аудита
+    if len(sys.argv) > 2 and sys.argv[1] == "import-logs":
+        print(f"Импортировано записей: {import_action_logs(sys.argv[2:])}")
+    else:
+        main()
\ No newline at end of file